@@ -0,0 +1,184 @@
+"""
+Streaming tar.gz and zip archives.
+
+Both are produced incrementally from `(path, mode, size, chunks)` entries,
+where `chunks` iterates over the file's contents, so memory use doesn't depend
+on the size of the archived files.
+"""
+import stat
+import time
+import zlib
+import struct
+import tarfile
+
+# archives are handed out in pieces of about this size
+BUFFER_SIZE = 64*1024
+
+
+def tar_gz_archive(entries, mtime, level=6):
+    """ Yields a gzip-compressed tar archive of `entries`. """
+    return _buffered(_tar_gz(entries, mtime, level))
+
+
+def zip_archive(entries, mtime, level=6):
+    """
+    Yields a zip archive of `entries`. Sizes and checksums are written after
+    each file's data, so they needn't be known up front.
+    """
+    return _buffered(_zip(entries, mtime, level))
+
+
+def _buffered(pieces):
+    buf, size = [], 0
+    for piece in pieces:
+        buf.append(piece)
+        size += len(piece)
+        if size >= BUFFER_SIZE:
+            yield ''.join(buf)
+            buf, size = [], 0
+    if buf:
+        yield ''.join(buf)
+
+
+def _tar_gz(entries, mtime, level):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    crc = size = 0
+    # gzip header: magic, deflate, no flags, mtime, no extra flags, Unix
+    yield '\x1f\x8b\x08\x00' + struct.pack('<L', mtime) + '\x00\x03'
+    for data in _tar(entries, mtime):
+        crc = zlib.crc32(data, crc)
+        size += len(data)
+        data = compressor.compress(data)
+        if data:
+            yield data
+    yield compressor.flush() + struct.pack('<LL', crc & 0xffffffff,
+                                           size & 0xffffffff)
+
+
+def _tar(entries, mtime):
+    size = 0
+    for path, mode, file_size, chunks in entries:
+        info = tarfile.TarInfo(path)
+        info.mtime = mtime
+        if stat.S_ISLNK(mode):
+            info.type = tarfile.SYMTYPE
+            info.linkname = ''.join(chunks)
+            info.mode = 0777
+            file_size = 0
+        else:
+            info.size = file_size
+            info.mode = 0755 if mode & 0111 else 0644
+        header = info.tobuf(tarfile.GNU_FORMAT)
+        size += len(header)
+        yield header
+        if file_size:
+            for chunk in chunks:
+                yield chunk
+            padding = -file_size % tarfile.BLOCKSIZE
+            size += file_size + padding
+            yield '\0' * padding
+    end = 2 * tarfile.BLOCKSIZE
+    end += -(size + end) % tarfile.RECORDSIZE
+    yield '\0' * end
+
+
+# beyond these, zip archives need ZIP64 extensions
+ZIP_MAX_SIZE = 0xffffffff
+ZIP_MAX_ENTRIES = 0xffff
+# placeholders for the values that are in the ZIP64 fields instead
+ZIP64_SIZE = 0xffffffff
+ZIP64_ENTRIES = 0xffff
+
+
+def _zip(entries, mtime, level):
+    t = time.localtime(mtime)
+    dos_date = (max(t.tm_year - 1980, 0) << 9) | (t.tm_mon << 5) | t.tm_mday
+    dos_time = (t.tm_hour << 11) | (t.tm_min << 5) | (t.tm_sec // 2)
+    directory = []
+    offset = 0
+    for path, mode, size, chunks in entries:
+        flags = 0x08  # sizes and CRC in a data descriptor
+        try:
+            path.decode('ascii')
+        except UnicodeDecodeError:
+            flags |= 0x800  # utf-8 filename
+        if stat.S_ISLNK(mode):
+            method, compressor = 0, None
+            mode = stat.S_IFLNK | 0777
+        else:
+            method = 8
+            compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+            mode = stat.S_IFREG | (0755 if mode & 0111 else 0644)
+        # The compressed size isn't known yet, but deflate adds at most a few
+        # bytes per 16 KB block to incompressible data.
+        zip64 = size + size // 1000 + 1024 > ZIP_MAX_SIZE
+        if zip64:
+            version = 45
+            # sizes in the data descriptor (and the central directory)
+            extra = struct.pack('<HHQQ', 0x0001, 16, 0, 0)
+            header_sizes = ZIP64_SIZE, ZIP64_SIZE
+        else:
+            version = 20
+            extra = ''
+            header_sizes = 0, 0
+        header = struct.pack('<LHHHHHLLLHH', 0x04034b50, version, flags, method,
+                             dos_time, dos_date, 0, header_sizes[0],
+                             header_sizes[1], len(path), len(extra)) + path + extra
+        yield header
+
+        crc = compressed_size = 0
+        for chunk in chunks:
+            crc = zlib.crc32(chunk, crc)
+            if compressor is not None:
+                chunk = compressor.compress(chunk)
+            compressed_size += len(chunk)
+            if chunk:
+                yield chunk
+        if compressor is not None:
+            chunk = compressor.flush()
+            compressed_size += len(chunk)
+            yield chunk
+        crc &= 0xffffffff
+        if zip64:
+            descriptor = struct.pack('<LLQQ', 0x08074b50, crc, compressed_size, size)
+        else:
+            descriptor = struct.pack('<LLLL', 0x08074b50, crc, compressed_size, size)
+        yield descriptor
+
+        # values that don't fit go into a ZIP64 extra field
+        extra_values = []
+        if zip64:
+            extra_values += [size, compressed_size]
+            sizes = ZIP64_SIZE, ZIP64_SIZE
+        else:
+            sizes = compressed_size, size
+        if offset >= ZIP_MAX_SIZE:
+            extra_values.append(offset)
+            version = 45
+        extra = ''
+        if extra_values:
+            extra = struct.pack('<HH', 0x0001, 8 * len(extra_values)) + \
+                    struct.pack('<%dQ' % len(extra_values), *extra_values)
+        directory.append(struct.pack(
+            '<LHHHHHHLLLHHHHHLL', 0x02014b50, (3 << 8) | version, version,
+            flags, method, dos_time, dos_date, crc, sizes[0], sizes[1],
+            len(path), len(extra), 0, 0, 0, mode << 16,
+            ZIP64_SIZE if offset >= ZIP_MAX_SIZE else offset
+        ) + path + extra)
+        offset += len(header) + compressed_size + len(descriptor)
+
+    count = len(directory)
+    directory = ''.join(directory)
+    yield directory
+    end = ''
+    if count >= ZIP_MAX_ENTRIES or len(directory) >= ZIP_MAX_SIZE or \
+       offset >= ZIP_MAX_SIZE:
+        # ZIP64 end of central directory record and its locator
+        end = struct.pack('<LQHHLLQQQQ', 0x06064b50, 44, (3 << 8) | 45, 45,
+                          0, 0, count, count, len(directory), offset)
+        end += struct.pack('<LLQL', 0x07064b50, 0, offset + len(directory), 1)
+        count, directory_size, offset = ZIP64_ENTRIES, ZIP64_SIZE, ZIP64_SIZE
+    else:
+        directory_size = len(directory)
+    yield end + struct.pack('<LHHHHLLH', 0x06054b50, 0, 0, count, count,
+                            directory_size, offset, 0)
@@ -0,0 +1,302 @@
+"""
+Benchmarks klaus' views against synthetic repositories.
+
+Builds a repository of the given shape with dulwich (deep history, wide trees,
+a huge file, a huge commit, many refs), then requests every view in a child
+process of its own through Flask's test client and reports latency
+percentiles and peak memory per view. Results are written as JSON, and
+``--compare`` prints the change against an earlier run::
+
+    python benchmark.py --out before.json
+    ... hack hack hack ...
+    python benchmark.py --out after.json --compare before.json
+
+The repository is built in ``--workdir`` and reused by later runs with the
+same shape and seed, so runs against different revisions use the same corpus.
+"""
+import os
+import json
+import time
+import random
+import shutil
+import argparse
+import resource
+import tempfile
+import threading
+import traceback
+import subprocess
+
+from dulwich.repo import Repo
+from dulwich.objects import Blob, Tree, Commit
+
+VIEWS = ['view_repo_list', 'view_history', 'view_blob', 'view_commit']
+REPO_NAME = 'bench'
+
+
+def make_lines(rng, count, prefix=''):
+    return ''.join('%sdef f%d(x):  # %s\n    return x + %d\n' % (
+        prefix, rng.randrange(10**6), 'x' * rng.randrange(40), i
+    ) for i in xrange(count // 2))
+
+
+def build_repo(path, shape):
+    """
+    Creates a bare repository at `path` with `shape['history']` commits on
+    master changing files of a tree of `shape['dirs']` directories with
+    `shape['files']` files each, plus a commit adding a file of
+    `shape['huge_file']` bytes, a commit changing `shape['huge_commit']` files
+    and `shape['refs']` tags and branches. Returns the URLs to request.
+    """
+    if shape['history'] < 2:
+        # the huge file and commit are added halfway through the history
+        raise ValueError("shape['history'] must be at least 2")
+    rng = random.Random(shape['seed'])
+    os.makedirs(path)
+    repo = Repo.init_bare(path)
+    objects = []
+    files = {}  # directory name -> {file name: blob sha}
+    dir_trees = {}
+
+    def add(obj):
+        objects.append((obj, None))
+        return obj.id
+
+    def set_file(directory, name, data):
+        files.setdefault(directory, {})[name] = add(Blob.from_string(data))
+        dir_trees.pop(directory, None)
+
+    def root_tree():
+        root = Tree()
+        for directory, entries in files.iteritems():
+            if directory not in dir_trees:
+                tree = Tree()
+                for name, sha in entries.iteritems():
+                    tree.add(name, 0100644, sha)
+                dir_trees[directory] = add(tree)
+            root.add(directory, 040000, dir_trees[directory])
+        return add(root)
+
+    commits = []
+    def commit(message):
+        c = Commit()
+        c.tree = root_tree()
+        c.parents = commits[-1:]
+        c.author = c.committer = 'Bench Mark <bench@example.com>'
+        c.commit_time = c.author_time = 1300000000 + len(commits) * 3600
+        c.commit_timezone = c.author_timezone = 0
+        c.message = '%s\n\nCommit number %d.\n' % (message, len(commits))
+        commits.append(add(c))
+
+    paths = []
+    for d in xrange(shape['dirs']):
+        for f in xrange(shape['files']):
+            directory, name = 'dir%03d' % d, 'file%04d.py' % f
+            set_file(directory, name, make_lines(rng, 40))
+            paths.append((directory, name))
+    commit('Initial commit')
+
+    for i in xrange(1, shape['history']):
+        for _ in xrange(rng.randint(1, 3)):
+            directory, name = rng.choice(paths)
+            set_file(directory, name, make_lines(rng, 40, prefix='# %d\n' % i))
+        commit('Change %d' % i)
+        if i == shape['history'] // 2:
+            huge_lines = shape['huge_file'] // 40
+            set_file('huge', 'huge.py', make_lines(rng, huge_lines))
+            commit('Add a huge file')
+            for directory, name in rng.sample(paths, min(shape['huge_commit'], len(paths))):
+                set_file(directory, name, make_lines(rng, 40, prefix='# huge\n'))
+            commit('Change lots of files')
+            huge_commit = commits[-1]
+
+    repo.object_store.add_objects(objects)
+    repo.refs['refs/heads/master'] = commits[-1]
+    with open(os.path.join(path, 'packed-refs'), 'wb') as f:
+        for i in xrange(shape['refs']):
+            kind = 'heads/branch' if i % 10 == 0 else 'tags/v'
+            f.write('%s refs/%s%05d\n' % (rng.choice(commits), kind, i))
+
+    urls = {
+        'view_repo_list': ['/'],
+        'view_history': [],
+        'view_blob': [],
+        'view_commit': ['/%s/commit/%s/' % (REPO_NAME, huge_commit)],
+    }
+    for i in xrange(20):
+        directory, name = rng.choice(paths)
+        urls['view_history'].append('/%s/tree/master/?page=%d' % (REPO_NAME, rng.randrange(20)))
+        urls['view_history'].append('/%s/tree/master/%s/%s' % (REPO_NAME, directory, name))
+        urls['view_blob'].append('/%s/blob/master/%s/%s' % (REPO_NAME, directory, name))
+        first = rng.randrange(huge_lines)
+        urls['view_blob'].append('/%s/blob/master/huge/huge.py?lines=%d-%d' % (
+            REPO_NAME, first, first + 999))
+        urls['view_commit'].append('/%s/commit/%s/' % (REPO_NAME, rng.choice(commits)))
+    return urls
+
+
+def percentile(values, p):
+    """ Nearest-rank percentile of the sorted list `values`. """
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(len(values) * p / 100.0))]
+
+
+def run_view(urls, requests, concurrency):
+    """
+    Requests `requests` URLs (cycling through `urls`) from `concurrency`
+    threads. Returns the list of latencies in seconds and the number of
+    requests that didn't get a 2xx/3xx response.
+    """
+    import klaus
+    todo = [urls[i % len(urls)] for i in xrange(requests)]
+    latencies = []
+    errors = [0]
+    lock = threading.Lock()
+
+    def worker():
+        client = klaus.app.test_client()
+        while True:
+            with lock:
+                if not todo:
+                    return
+                url = todo.pop(0)
+            start = time.time()
+            try:
+                response = client.get(url)
+                # make sure streamed responses are rendered completely
+                response.get_data()
+                failed = response.status_code >= 400
+            except Exception:
+                traceback.print_exc()
+                failed = True
+            duration = time.time() - start
+            with lock:
+                latencies.append(duration)
+                errors[0] += failed
+
+    threads = [threading.Thread(target=worker) for _ in xrange(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return latencies, errors[0]
+
+
+def measure(urls, requests, concurrency):
+    """ Runs `run_view` in a child process and returns its statistics. """
+    read_end, write_end = os.pipe()
+    pid = os.fork()
+    if not pid:
+        os.close(read_end)
+        rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        latencies, errors = run_view(urls, requests, concurrency)
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        with os.fdopen(write_end, 'wb') as f:
+            json.dump([latencies, errors, rss, rss - rss_before], f)
+        os._exit(0)
+    os.close(write_end)
+    with os.fdopen(read_end, 'rb') as f:
+        latencies, errors, rss, rss_growth = json.load(f)
+    os.waitpid(pid, 0)
+    cold = latencies[0]
+    latencies.sort()
+    ms = lambda seconds: round(seconds * 1000, 2) if seconds is not None else None
+    return {
+        'requests': len(latencies),
+        'errors': errors,
+        'cold_ms': ms(cold),
+        'mean_ms': ms(sum(latencies) / len(latencies)),
+        'p50_ms': ms(percentile(latencies, 50)),
+        'p95_ms': ms(percentile(latencies, 95)),
+        'p99_ms': ms(percentile(latencies, 99)),
+        'peak_rss_kb': rss,
+        'rss_growth_kb': rss_growth,
+    }
+
+
+def revision():
+    try:
+        return subprocess.check_output(
+            ['git', 'describe', '--always', '--dirty'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=open(os.devnull, 'w')
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--workdir', default=os.path.join(tempfile.gettempdir(), 'klaus-benchmark'))
+    parser.add_argument('--out', help='write results to this JSON file')
+    parser.add_argument('--compare', help='JSON file of an earlier run')
+    parser.add_argument('--views', nargs='+', choices=VIEWS, default=VIEWS)
+    parser.add_argument('--requests', type=int, default=100, help='per view')
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--history', type=int, default=2000, help='number of commits')
+    parser.add_argument('--dirs', type=int, default=20)
+    parser.add_argument('--files', type=int, default=50, help='per directory')
+    parser.add_argument('--huge-file', type=int, default=5*1024*1024, help='in bytes')
+    parser.add_argument('--huge-commit', type=int, default=500, help='files changed')
+    parser.add_argument('--refs', type=int, default=2000)
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+    if args.history < 2:
+        parser.error('--history must be at least 2')
+
+    shape = dict((key, getattr(args, key)) for key in
+                 ['history', 'dirs', 'files', 'huge_file', 'huge_commit', 'refs', 'seed'])
+    corpus = os.path.join(args.workdir, '-'.join('%s%s' % item for item in sorted(shape.items())))
+    urls_file = os.path.join(corpus, 'urls.json')
+    if not os.path.exists(urls_file):
+        print 'Building repository in %s...' % corpus
+        shutil.rmtree(corpus, ignore_errors=True)
+        urls = build_repo(os.path.join(corpus, REPO_NAME), shape)
+        with open(urls_file, 'wb') as f:
+            json.dump(urls, f)
+    with open(urls_file, 'rb') as f:
+        urls = json.load(f)
+
+    os.environ['KLAUS_BASE_PATH'] = corpus + os.sep
+    os.environ['KLAUS_REPOS'] = REPO_NAME
+    # measure the views only, not background work started by them
+    os.environ['KLAUS_NO_BACKGROUND_INDEXING'] = '1'
+    import klaus
+
+    results = {
+        'revision': revision(),
+        'shape': shape,
+        'requests': args.requests,
+        'concurrency': args.concurrency,
+        'views': {},
+    }
+    print '%-16s %8s %8s %8s %8s %8s %10s' % ('view', 'cold', 'p50', 'p95', 'p99', 'errors', 'peak RSS')
+    for view in args.views:
+        stats = measure([str(url) for url in urls[view]], args.requests, args.concurrency)
+        results['views'][view] = stats
+        print '%-16s %6.1fms %6.1fms %6.1fms %6.1fms %8d %8dKB' % (
+            view, stats['cold_ms'], stats['p50_ms'], stats['p95_ms'],
+            stats['p99_ms'], stats['errors'], stats['peak_rss_kb'])
+
+    if args.out:
+        with open(args.out, 'wb') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+    if args.compare:
+        with open(args.compare, 'rb') as f:
+            old = json.load(f)
+        print
+        print 'Compared to %s (%s):' % (args.compare, old.get('revision'))
+        for view, stats in sorted(results['views'].iteritems()):
+            if view not in old['views']:
+                continue
+            changes = []
+            for key in ['p50_ms', 'p95_ms', 'p99_ms', 'peak_rss_kb']:
+                before = old['views'][view][key]
+                if before:
+                    changes.append('%s %+.0f%%' % (key, (stats[key] - before) * 100.0 / before))
+            print '%-16s %s' % (view, '  '.join(changes))
+
+
+if __name__ == '__main__':
+    main()
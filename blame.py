@@ -0,0 +1,144 @@
+"""
+Line-by-line blame of files, following first-parent history.
+
+The lines to blame are traced backwards through the commits that changed the
+file (as found by the history index), diffing each with its first parent:
+lines a commit added are blamed on it, all others are followed into the
+parent's version of the file. The walk stops as soon as every line has been
+blamed, or when it reaches a commit whose whole blame is cached. So the blame
+of a new commit takes one diff on top of its predecessor's, and a window of a
+large file usually needs only the few most recent changes.
+
+Like ``git blame --first-parent``, lines from merged branches are blamed on
+the merge commit. Renames aren't followed.
+"""
+import os
+import hashlib
+import marshal
+
+import metrics
+from diff import split_lines, matching_blocks
+from cache import LRUCache, DiskCache, cache_dir
+
+# blames as lists of `(commit sha, number of lines)` runs by key (see
+# `_cache_key`), measured by their number of runs
+blame_cache = LRUCache(
+    int(os.environ.get('KLAUS_BLAME_CACHE_SIZE', 1000*1000)),
+    sizeof=len, name='blame'
+)
+blame_disk_cache = DiskCache(cache_dir('blame'))
+
+
+def _cache_key(sha, path, start=None, stop=None):
+    parts = [sha, path]
+    if start is not None:
+        parts += [str(start), str(stop)]
+    return hashlib.sha1('\0'.join(parts)).hexdigest()
+
+
+def _get_cached(key):
+    runs = blame_cache.get(key)
+    if runs is None:
+        string = blame_disk_cache.get(key)
+        if string is None:
+            return None
+        runs = marshal.loads(string)
+        blame_cache.set(key, runs)
+    return _expand(runs)
+
+
+def _set_cached(key, shas):
+    runs = _compress(shas)
+    blame_cache.set(key, runs)
+    blame_disk_cache.set(key, marshal.dumps(runs))
+
+
+def _compress(shas):
+    runs = []
+    for sha in shas:
+        if runs and runs[-1][0] == sha:
+            runs[-1][1] += 1
+        else:
+            runs.append([sha, 1])
+    return [tuple(run) for run in runs]
+
+
+def _expand(runs):
+    shas = []
+    for sha, count in runs:
+        shas.extend([sha] * count)
+    return shas
+
+
+def _file_lines(repo, commit, path):
+    """ Returns the lines of `path` in `commit` or `None` if it isn't there. """
+    try:
+        mode, sha = repo.lookup_path(commit, path)
+    except KeyError:
+        return None
+    return split_lines(''.join(repo.open_blob(sha)[1]))
+
+
+@metrics.timed('blame')
+def blame(repo, commit, path, start=0, stop=None):
+    """
+    Returns the shas of the commits that last changed the lines `start` to
+    `stop` (zero-based, exclusive; all lines by default) of `path` in
+    `commit`.
+    """
+    changes = repo.history_index.history(repo, commit, path)
+    if not changes:
+        raise KeyError(path)
+    lines = _file_lines(repo, repo[changes[0]], path)
+    if lines is None:
+        raise KeyError(path)
+    if stop is None or stop > len(lines):
+        stop = len(lines)
+    result = _get_cached(_cache_key(changes[0], path))
+    if result is not None:
+        return result[start:stop]
+    if start == 0 and stop == len(lines):
+        key = _cache_key(changes[0], path)
+    else:
+        key = _cache_key(changes[0], path, start, stop)
+        result = _get_cached(key)
+        if result is not None:
+            return result
+
+    result = [None] * (stop - start)
+    # line number in the current version -> index in `result`
+    unresolved = dict((line, line - start) for line in xrange(start, stop))
+    for i, sha in enumerate(changes):
+        if not unresolved:
+            break
+        if i:
+            # the whole blame of an older version might be known
+            cached = _get_cached(_cache_key(sha, path))
+            if cached is not None:
+                for line, index in unresolved.iteritems():
+                    result[index] = cached[line]
+                unresolved = {}
+                break
+        change = repo[sha]
+        old_lines = None
+        if change.parents:
+            old_lines = _file_lines(repo, repo[change.parents[0]], path)
+        if old_lines is None:
+            break
+        followed = {}
+        for i1, j1, n in matching_blocks(old_lines, lines):
+            for line in xrange(j1, j1 + n):
+                index = unresolved.pop(line, None)
+                if index is not None:
+                    followed[i1 + line - j1] = index
+        for index in unresolved.itervalues():
+            result[index] = sha
+        # the parent's version is the one of the next older change
+        lines, unresolved = old_lines, followed
+        metrics.count('blame_diffs')
+    # the rest was added by the oldest change (or when the file was created)
+    for index in unresolved.itervalues():
+        result[index] = sha
+
+    _set_cached(key, result)
+    return result
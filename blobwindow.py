@@ -0,0 +1,272 @@
+"""
+Highlighting of line windows of (large) blobs.
+
+For every blob a `LineIndex` is built once: the byte offset of every line and,
+for lexers based on `RegexLexer`, the lexer's state stack at a line start
+every `CHECKPOINT_LINES` lines. A window is highlighted by lexing from the last
+checkpoint before it, so the cost of a page doesn't depend on the blob's size
+and multi-line constructs (comments, strings) are still highlighted correctly.
+"""
+import os
+import array
+import marshal
+import hashlib
+from bisect import bisect_right
+
+import pygments
+from pygments.lexer import RegexLexer
+from pygments.lexers import get_lexer_for_filename, guess_lexer, \
+                            find_lexer_class, ClassNotFound
+from pygments.token import Text, Error, _TokenType
+from pygments.formatters import HtmlFormatter
+
+import workers
+import metrics
+from cache import LRUCache, DiskCache, cache_dir
+
+CHECKPOINT_LINES = 500
+
+# line indexes by blob sha and filename (the lexer depends on it)
+line_index_cache = LRUCache(
+    int(os.environ.get('KLAUS_LINE_INDEX_CACHE_SIZE', 16*1024*1024)),
+    sizeof=lambda index: index.size, name='line_index'
+)
+line_index_disk_cache = DiskCache(cache_dir('lineindex'))
+
+
+class LineIndex(object):
+    """
+    `offsets` holds the byte offset of every line followed by the size of the
+    blob. `checkpoints` is a list of `(line, state stack)` tuples sorted by
+    line, or `None` if the lexer doesn't support resuming.
+    """
+    def __init__(self, offsets, encoding, lexer_name, checkpoints):
+        self.offsets = offsets
+        self.encoding = encoding
+        self.lexer_name = lexer_name
+        self.checkpoints = checkpoints
+        self.size = offsets.itemsize * len(offsets) + \
+                    100 * len(checkpoints or ())
+
+    @property
+    def line_count(self):
+        return len(self.offsets) - 1
+
+    def dumps(self):
+        return marshal.dumps((self.offsets.tostring(), self.encoding,
+                              self.lexer_name, self.checkpoints))
+
+    @classmethod
+    def loads(cls, string):
+        offsets, encoding, lexer_name, checkpoints = marshal.loads(string)
+        return cls(array.array('L', offsets), encoding, lexer_name, checkpoints)
+
+
+@metrics.timed('highlight')
+def get_line_index(sha, filename, load_data):
+    """
+    Returns the `LineIndex` of the blob `sha`, building it from the blob's
+    contents (as returned by `load_data()`) if it isn't cached.
+    """
+    key = hashlib.sha1('\0'.join([
+        sha, (filename or '').encode('utf-8'), pygments.__version__,
+        str(CHECKPOINT_LINES)
+    ])).hexdigest()
+    index = line_index_cache.get(key)
+    if index is not None:
+        return index
+    string = line_index_disk_cache.get(key)
+    if string is not None:
+        index = LineIndex.loads(string)
+        line_index_cache.set(key, index)
+        return index
+
+    data = load_data()
+    fallback = []
+    def build_without_checkpoints():
+        fallback.append(True)
+        return build_line_index(data, filename, checkpoints=False)
+    index = workers.pool.run(build_line_index, (data, filename),
+                             build_without_checkpoints)
+    # The index without checkpoints is kept in memory only, so it's built
+    # properly again once it's been evicted (e.g. after a restart), but
+    # windows of the blob needn't wait for the workers until then.
+    if not fallback:
+        line_index_disk_cache.set(key, index.dumps())
+    line_index_cache.set(key, index)
+    return index
+
+
+def build_line_index(data, filename, checkpoints=True):
+    try:
+        text = data.decode('utf-8')
+        encoding = 'utf-8'
+    except UnicodeDecodeError:
+        encoding = 'iso-8859-1'
+        text = data.decode(encoding)
+
+    # '\n' is never part of a multi-byte character in either encoding, so
+    # lines are the same in `data` and `text`.
+    offsets = array.array('L', [0] if data else [])
+    pos = data.find('\n')
+    while pos != -1 and pos + 1 < len(data):
+        offsets.append(pos + 1)
+        pos = data.find('\n', pos + 1)
+    offsets.append(len(data))
+
+    try:
+        lexer = get_lexer_for_filename(filename)
+    except ClassNotFound:
+        lexer = guess_lexer(text[:10*1024])
+
+    if checkpoints and _can_resume(lexer):
+        checkpoints = [(0, ('root',))]
+        # otherwise every window is lexed from the start of the blob
+        if LEX_SUPPORTED:
+            for _ in _lex(lexer, _normalize(text) + '\n', checkpoints):
+                pass
+    else:
+        checkpoints = None
+    return LineIndex(offsets, encoding, lexer.name, checkpoints)
+
+
+@metrics.timed('highlight')
+def highlight_window(index, read, start, stop):
+    """
+    Returns the lines `start` to `stop` (zero-based, exclusive) of a blob
+    highlighted as HTML. `read(start, stop)` must return the given byte range
+    of the blob.
+    """
+    offsets = index.offsets
+    if index.checkpoints is None:
+        # no way to resume the lexer; start afresh at the window
+        line, stack = start, None
+    else:
+        i = bisect_right([line for line, _ in index.checkpoints], start) - 1
+        line, stack = index.checkpoints[i]
+    # Some tokens (e.g. Python docstrings) are only recognized once their
+    # end has been seen, so lex a bit beyond the window as well.
+    end = min(stop + CHECKPOINT_LINES, index.line_count)
+    data = read(offsets[line], offsets[end])
+    pieces = [_normalize(data[i:j].decode(index.encoding)) for i, j in [
+        (0, offsets[start] - offsets[line]),
+        (offsets[start] - offsets[line], offsets[stop] - offsets[line]),
+        (offsets[stop] - offsets[line], len(data)),
+    ]]
+    formatter = HtmlFormatter(linenos=True, linenostart=start+1)
+    return workers.pool.run(
+        _highlight_pieces, (index.lexer_name, stack, pieces, formatter),
+        lambda: pygments.format([(Text, pieces[1])], formatter)
+    )
+
+
+def _highlight_pieces(lexer_name, stack, pieces, formatter):
+    """ Highlights the middle one of three pieces of text. """
+    lexer = find_lexer_class(lexer_name)()
+    text = u''.join(pieces)
+    if not text.endswith('\n'):
+        # like `Lexer.get_tokens` with `ensurenl`
+        text += '\n'
+    if stack is None:
+        tokens = lexer.get_tokens_unprocessed(text)
+    else:
+        tokens = lexer.get_tokens_unprocessed(text, stack)
+    first = len(pieces[0])
+    return pygments.format(_clip(tokens, first, first + len(pieces[1])),
+                           formatter)
+
+
+def _normalize(text):
+    # like `Lexer.get_tokens`, but without changing the number of lines
+    return text.replace('\r\n', '\n')
+
+
+def _clip(tokens, start, stop):
+    """
+    Yields `(tokentype, value)` for the text of `tokens` from `start` to
+    `stop`.
+    """
+    for pos, tokentype, value in tokens:
+        if pos >= stop:
+            break
+        if pos + len(value) <= start:
+            continue
+        yield tokentype, value[max(start-pos, 0):stop-pos]
+
+
+def _can_resume(lexer):
+    """
+    Whether `lexer` uses `RegexLexer`'s lexing loop unchanged, which can be
+    resumed with a given state stack.
+    """
+    method = type(lexer).get_tokens_unprocessed
+    return isinstance(lexer, RegexLexer) and \
+           method.im_func is RegexLexer.get_tokens_unprocessed.im_func
+
+
+# `_lex` is a copy of `RegexLexer.get_tokens_unprocessed` as of these versions
+# of Pygments; others might lex differently.
+LEX_PYGMENTS_VERSIONS = ('1.', '2.')
+LEX_SUPPORTED = pygments.__version__.startswith(LEX_PYGMENTS_VERSIONS)
+
+def _lex(lexer, text, checkpoints):
+    """
+    `RegexLexer.get_tokens_unprocessed`, but additionally appends a
+    `(line, state stack)` tuple to `checkpoints` whenever a token starts at the
+    beginning of a line at least `CHECKPOINT_LINES` after the last checkpoint.
+    """
+    pos = 0
+    line, line_pos = 0, 0
+    next_checkpoint = checkpoints[-1][0] + CHECKPOINT_LINES
+    tokendefs = lexer._tokens
+    statestack = list(checkpoints[-1][1])
+    statetokens = tokendefs[statestack[-1]]
+    while 1:
+        line += text.count('\n', line_pos, pos)
+        line_pos = pos
+        if line >= next_checkpoint and pos and text[pos-1] == '\n':
+            checkpoints.append((line, tuple(statestack)))
+            next_checkpoint = line + CHECKPOINT_LINES
+        for rexmatch, action, new_state in statetokens:
+            m = rexmatch(text, pos)
+            if m:
+                if action is not None:
+                    if type(action) is _TokenType:
+                        yield pos, action, m.group()
+                    else:
+                        for item in action(lexer, m):
+                            yield item
+                pos = m.end()
+                if new_state is not None:
+                    if isinstance(new_state, tuple):
+                        for state in new_state:
+                            if state == '#pop':
+                                if len(statestack) > 1:
+                                    statestack.pop()
+                            elif state == '#push':
+                                statestack.append(statestack[-1])
+                            else:
+                                statestack.append(state)
+                    elif isinstance(new_state, int):
+                        if abs(new_state) >= len(statestack):
+                            del statestack[1:]
+                        else:
+                            del statestack[new_state:]
+                    elif new_state == '#push':
+                        statestack.append(statestack[-1])
+                    else:
+                        assert False, "wrong state def: %r" % new_state
+                    statetokens = tokendefs[statestack[-1]]
+                break
+        else:
+            try:
+                if text[pos] == '\n':
+                    statestack = ['root']
+                    statetokens = tokendefs['root']
+                    yield pos, Text, u'\n'
+                    pos += 1
+                    continue
+                yield pos, Error, text[pos]
+                pos += 1
+            except IndexError:
+                break
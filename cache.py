@@ -0,0 +1,325 @@
+"""
+Building blocks for klaus' caches.
+
+Persistent caches live below the ``KLAUS_CACHE_DIR`` directory. If that
+environment variable isn't set, everything is kept in memory only.
+"""
+import os
+import fcntl
+import marshal
+import hashlib
+import tempfile
+import threading
+import collections
+
+import metrics
+
+CACHE_DIR = os.environ.get('KLAUS_CACHE_DIR') or None
+# bytes each `DiskCache` may take up
+DISK_CACHE_SIZE = int(os.environ.get('KLAUS_DISK_CACHE_SIZE', 1024*1024*1024))
+
+
+def cache_dir(name):
+    """
+    Returns the directory for the cache `name` (creating it if necessary) or
+    `None` if persistent caching is disabled or impossible.
+    """
+    if CACHE_DIR is None:
+        return None
+    path = os.path.join(CACHE_DIR, name)
+    try:
+        os.makedirs(path)
+    except OSError:
+        if not os.path.isdir(path):
+            return None
+    return path
+
+
+def repo_cache_dir(repo_path):
+    """
+    Returns the cache directory for the repository at `repo_path` (creating it
+    if necessary) or `None` if persistent caching is disabled or impossible.
+    """
+    name = hashlib.sha1(os.path.abspath(repo_path)).hexdigest()
+    return cache_dir(os.path.join('repos', name))
+
+
+# named `LRUCache`s by name, for statistics
+caches = {}
+
+
+class LRUCache(object):
+    """
+    A thread-safe mapping that holds at most `max_size` worth of values, as
+    measured by `sizeof` (by default every value has a size of 1), evicting
+    the least recently used ones. If a `name` is given, the cache is listed in
+    `caches` and its hits and misses are counted per request by `metrics`.
+    """
+    def __init__(self, max_size, sizeof=None, name=None):
+        if name is not None:
+            caches[name] = self
+        self.name = name
+        self.max_size = max_size
+        self.sizeof = sizeof or (lambda value: 1)
+        self.size = 0
+        self.hits = self.misses = self.evictions = 0
+        self._data = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value, size = self._data.pop(key)
+            except KeyError:
+                self.misses += 1
+                if metrics.ENABLED and self.name:
+                    metrics.count(self.name + '_cache_misses')
+                return default
+            self._data[key] = value, size
+            self.hits += 1
+        if metrics.ENABLED and self.name:
+            metrics.count(self.name + '_cache_hits')
+        return value
+
+    def keys(self):
+        with self._lock:
+            return self._data.keys()
+
+    def delete(self, key):
+        with self._lock:
+            old = self._data.pop(key, None)
+            if old is not None:
+                self.size -= old[1]
+
+    def set(self, key, value):
+        size = self.sizeof(value)
+        with self._lock:
+            old = self._data.pop(key, None)
+            if old is not None:
+                self.size -= old[1]
+            if size > self.max_size:
+                # too big to be cached; the old value is outdated, too
+                return
+            self._data[key] = value, size
+            self.size += size
+            while self.size > self.max_size:
+                _, (_, evicted_size) = self._data.popitem(last=False)
+                self.size -= evicted_size
+                self.evictions += 1
+
+
+class DiskCache(object):
+    """
+    Stores strings in files below `directory`, named by their (hex) keys.
+    Files are replaced atomically, so the directory may be shared by several
+    processes. If `directory` is `None`, nothing is stored.
+
+    Whenever this process has written a tenth of `max_size` bytes (and on its
+    first write), the least recently used files are removed until all of them
+    together take up at most `max_size` bytes.
+    """
+    def __init__(self, directory, max_size=DISK_CACHE_SIZE):
+        self.directory = directory
+        self.max_size = max_size
+        self._written = max_size // 10
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        if self.directory is None:
+            return default
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                value = f.read()
+        except IOError:
+            return default
+        try:
+            # the modification time doubles as the time of last use
+            os.utime(path, None)
+        except OSError:
+            pass
+        return value
+
+    def set(self, key, value):
+        if self.directory is None:
+            return
+        path = self._path(key)
+        try:
+            try:
+                os.mkdir(os.path.dirname(path))
+            except OSError:
+                pass
+            fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.tmp')
+            with os.fdopen(fd, 'wb') as f:
+                f.write(value)
+            os.rename(tmp, path)
+        except (IOError, OSError):
+            # caching is best effort
+            return
+        with self._lock:
+            self._written += len(value)
+            if self._written < self.max_size // 10:
+                return
+            self._written = 0
+        self.evict()
+
+    def evict(self):
+        files = []
+        for dirpath, dirnames, filenames in os.walk(self.directory):
+            for name in filenames:
+                if not name.startswith('.tmp'):
+                    path = os.path.join(dirpath, name)
+                    try:
+                        st = os.stat(path)
+                    except OSError:
+                        continue
+                    files.append((st.st_mtime, st.st_size, path))
+        _remove_oldest(files, self.max_size)
+
+    def _path(self, key):
+        return os.path.join(self.directory, key[:2], key[2:])
+
+
+class FileCache(object):
+    """
+    Stores files below `directory`, named by their keys, removing the least
+    recently used ones once all of them together take up more than `max_size`
+    bytes. If `directory` is `None`, nothing is stored.
+    """
+    def __init__(self, directory, max_size):
+        self.directory = directory
+        self.max_size = max_size
+
+    def get(self, key):
+        """ Returns the path of the file stored for `key` or `None`. """
+        if self.directory is None:
+            return None
+        path = os.path.join(self.directory, key)
+        try:
+            # the modification time doubles as the time of last use
+            os.utime(path, None)
+        except OSError:
+            return None
+        return path
+
+    def tee(self, key, chunks):
+        """
+        Yields `chunks`, storing them as the file for `key` once all of them
+        were consumed.
+        """
+        if self.directory is None:
+            for chunk in chunks:
+                yield chunk
+            return
+        try:
+            fd, tmp = tempfile.mkstemp(dir=self.directory, prefix='.tmp')
+        except OSError:
+            for chunk in chunks:
+                yield chunk
+            return
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                for chunk in chunks:
+                    f.write(chunk)
+                    yield chunk
+            os.rename(tmp, os.path.join(self.directory, key))
+        except (IOError, OSError):
+            # caching is best effort
+            pass
+        finally:
+            # also gets rid of the file if the client went away
+            if os.path.exists(tmp):
+                os.unlink(tmp)
+        self.evict()
+
+    def evict(self):
+        files = []
+        try:
+            for name in os.listdir(self.directory):
+                if not name.startswith('.tmp'):
+                    path = os.path.join(self.directory, name)
+                    st = os.stat(path)
+                    files.append((st.st_mtime, st.st_size, path))
+        except OSError:
+            return
+        _remove_oldest(files, self.max_size)
+
+
+def _remove_oldest(files, max_size):
+    """
+    Removes the oldest of `files` (`(mtime, size, path)` tuples) until the
+    rest take up at most `max_size` bytes.
+    """
+    files.sort()
+    size = sum(size for _, size, _ in files)
+    for _, file_size, path in files:
+        if size <= max_size:
+            break
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
+        size -= file_size
+
+
+class RecordLog(object):
+    """
+    An append-only file of marshalled records that may be shared by several
+    processes. If `path` is `None`, nothing is persisted.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.offset = 0
+
+    def read(self):
+        """
+        Returns the records that were appended (by any process) since the last
+        call to `read` or `append`.
+        """
+        if self.path is None:
+            return []
+        try:
+            f = open(self.path, 'rb')
+        except IOError:
+            return []
+        with f:
+            return self._read(f)
+
+    def append(self, records):
+        """
+        Appends `records` to the log. Returns the records other processes
+        appended since the last call to `read` or `append`.
+        """
+        if self.path is None:
+            return []
+        try:
+            f = open(self.path, 'a+b')
+        except IOError:
+            return []
+        with f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            new = self._read(f)
+            f.seek(0, os.SEEK_END)
+            if f.tell() > self.offset:
+                # Writers hold the lock, so this is a record left over by a
+                # crashed process. Get rid of it or we'd append to garbage.
+                f.truncate(self.offset)
+            f.write(''.join(marshal.dumps(record) for record in records))
+            f.flush()
+            self.offset = f.tell()
+        return new
+
+    def _read(self, f):
+        f.seek(self.offset)
+        records = []
+        while True:
+            try:
+                records.append(marshal.load(f))
+            except (EOFError, ValueError, TypeError):
+                # end of file or a record that's still being written
+                break
+            self.offset = f.tell()
+        return records
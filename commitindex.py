@@ -0,0 +1,323 @@
+"""
+Persistent, column-oriented index of commit metadata.
+
+Every commit gets a row number, and parents always get lower numbers than
+their children. The rows' data is kept in columns (parents, tree, author,
+commit time, generation number, subject) plus inverted indexes from authors
+and from the (lowercased) words of the messages to rows, so commits can be
+searched by author, date and message without reading any commit objects. New
+commits are indexed when a search or walk reaches them, reading only those.
+
+The parent, commit time and generation columns double as a commit graph like
+git's: walks over all parents, in date or topological order, and ancestry
+checks don't read commit objects either. A commit's generation number is one
+more than the highest of its parents' (roots have 1). Rows are assigned
+depth-first, so walking them from the highest row down shows each merged
+branch as a whole, much like ``git log --topo-order``.
+"""
+import os
+import re
+import array
+import heapq
+import threading
+
+from cache import LRUCache, RecordLog, repo_cache_dir
+
+# number of commits to index before the records are written to disk
+FLUSH_EVERY = 1000
+
+# orders of `CommitIndex.walk`
+ORDERS = ('date', 'topo')
+
+WORD_RE = re.compile(r'\w+', re.UNICODE)
+
+# rows reachable from a commit (as a bytearray flag per row) by repository
+# path and commit sha, measured in bytes
+reachable_cache = LRUCache(
+    int(os.environ.get('KLAUS_REACHABLE_CACHE_SIZE', 16*1024*1024)),
+    sizeof=len, name='reachable'
+)
+
+
+def message_words(message):
+    """ Returns the set of lowercased words in the (byte string) `message`. """
+    return set(WORD_RE.findall(message.decode('utf-8', 'replace').lower()))
+
+
+class CommitIndex(object):
+    def __init__(self, path):
+        self.path = path
+        cache_dir = repo_cache_dir(path)
+        self.log = RecordLog(cache_dir and os.path.join(cache_dir, 'commits'))
+        self.lock = threading.Lock()
+        self.rows = {}  # sha -> row
+        # the columns. They are only ever appended to, and `shas` last, so
+        # walks can read the rows below `len(shas)` without the lock.
+        self.shas = []
+        self.first_parents = array.array('l')  # -1 for root commits
+        self.merge_parents = {}  # row -> rows of the other parents
+        self.trees = []
+        self.author_ids = array.array('L')
+        self.commit_times = array.array('l')
+        self.generations = array.array('l')
+        self.subjects = []
+        # author -> author id, and back
+        self.author_numbers = {}
+        self.authors = []
+        self.lowercase_authors = []
+        # author id -> rows
+        self.author_rows = []
+        # word -> rows
+        self.word_rows = {}
+        self._add_records(self.log.read())
+
+    def __contains__(self, sha):
+        return sha in self.rows
+
+    def update(self, repo, commit):
+        """
+        Indexes `commit` (of `repo`) and all of its ancestors that aren't
+        indexed yet. This is cheap if the commit has already been indexed.
+        """
+        if commit.id in self.rows:
+            return
+        with self.lock:
+            self._add_records(self.log.read())
+            # depth-first, so parents are added before their children. Only
+            # shas are kept on the stack, which may hold the whole history.
+            records = []
+            stack = [commit.id]
+            while stack:
+                sha = stack[-1]
+                if sha in self.rows:
+                    stack.pop()
+                    continue
+                commit = repo[sha]
+                missing = [parent for parent in commit.parents
+                           if parent not in self.rows]
+                if missing:
+                    stack.extend(missing)
+                    continue
+                stack.pop()
+                record = (commit.id, tuple(commit.parents), commit.author,
+                          commit.commit_time, commit.message.split('\n', 1)[0],
+                          tuple(message_words(commit.message)), commit.tree)
+                self._add_record(*record)
+                records.append(record)
+                if len(records) >= FLUSH_EVERY:
+                    self._add_records(self.log.append(records))
+                    records = []
+            self._add_records(self.log.append(records))
+
+    def _add_records(self, records):
+        for record in records:
+            try:
+                self._add_record(*record)
+            except KeyError:
+                # parent unknown, e.g. because of a lost write. The commit
+                # will be indexed again when it is needed.
+                pass
+
+    def _add_record(self, sha, parents, author, commit_time, subject, words,
+                    tree=None):
+        # (records written before trees were indexed have none)
+        if sha in self.rows:
+            return
+        parent_rows = [self.rows[parent] for parent in parents]
+        row = len(self.shas)
+        self.first_parents.append(parent_rows[0] if parent_rows else -1)
+        if len(parent_rows) > 1:
+            self.merge_parents[row] = parent_rows[1:]
+        self.trees.append(tree)
+        self.generations.append(
+            1 + max([self.generations[parent] for parent in parent_rows] or [0]))
+        author_id = self.author_numbers.get(author)
+        if author_id is None:
+            author_id = self.author_numbers[author] = len(self.authors)
+            self.authors.append(author)
+            self.lowercase_authors.append(author.decode('utf-8', 'replace').lower())
+            self.author_rows.append(array.array('L'))
+        self.author_ids.append(author_id)
+        self.author_rows[author_id].append(row)
+        self.commit_times.append(commit_time)
+        self.subjects.append(subject)
+        for word in words:
+            rows = self.word_rows.get(word)
+            if rows is None:
+                rows = self.word_rows[word] = array.array('L')
+            rows.append(row)
+        self.shas.append(sha)
+        self.rows[sha] = row
+
+    def reachable(self, sha):
+        """
+        Returns a bytearray that is non-zero at the rows of the commits
+        reachable from the (indexed) commit `sha`.
+        """
+        key = (self.path, sha)
+        flags = reachable_cache.get(key)
+        if flags is not None:
+            return flags
+        first_parents, merge_parents = self.first_parents, self.merge_parents
+        flags = bytearray(len(self.shas))
+        stack = [self.rows[sha]]
+        while stack:
+            row = stack.pop()
+            # follow the first-parent chain without going through the stack
+            while row != -1 and not flags[row]:
+                flags[row] = 1
+                if row in merge_parents:
+                    stack.extend(merge_parents[row])
+                row = first_parents[row]
+        reachable_cache.set(key, flags)
+        return flags
+
+    def search(self, repo, commit, author=None, since=None, until=None,
+               words=(), shas=None, max_commits=None, skip=0):
+        """
+        Returns `(sha, author, commit time, subject)` tuples of the commits
+        reachable from `commit` (of `repo`) whose author contains `author` (a unicode
+        string, compared case-insensitively), whose commit time is in
+        [`since`, `until`) and whose message contains all of `words` (see
+        `message_words`), newest first. If `shas` is given, only those
+        commits are considered.
+        """
+        self.update(repo, commit)
+        with self.lock:
+            candidates = None
+            if shas is not None:
+                candidates = set(self.rows[sha] for sha in shas if sha in self.rows)
+            if author:
+                author = author.lower()
+                author_rows = set()
+                for author_id, name in enumerate(self.lowercase_authors):
+                    if author in name:
+                        author_rows.update(self.author_rows[author_id])
+                candidates = _intersect(candidates, author_rows)
+            for word in words:
+                candidates = _intersect(candidates, self.word_rows.get(word, ()))
+            if candidates is None:
+                candidates = xrange(len(self.shas))
+
+            reachable = self.reachable(commit.id)
+            # commits indexed later aren't reachable
+            count = len(reachable)
+            times = self.commit_times
+            if since is None:
+                since = float('-inf')
+            if until is None:
+                until = float('inf')
+            result = [row for row in candidates
+                      if row < count and reachable[row] and since <= times[row] < until]
+            result.sort(key=lambda row: (times[row], row), reverse=True)
+            if max_commits is None:
+                result = result[skip:]
+            else:
+                result = result[skip:skip+max_commits]
+            return [(self.shas[row], self.authors[self.author_ids[row]],
+                     times[row], self.subjects[row]) for row in result]
+
+
+    def parents(self, row):
+        """ Returns the rows of the parents of `row`. """
+        first = self.first_parents[row]
+        if first == -1:
+            return []
+        return [first] + self.merge_parents.get(row, [])
+
+    def tree(self, repo, row):
+        """ Returns the sha of the tree of `row`, a commit of `repo`. """
+        tree = self.trees[row]
+        if tree is None:
+            tree = self.trees[row] = repo[self.shas[row]].tree
+        return tree
+
+    def is_ancestor(self, repo, sha, commit):
+        """
+        Returns whether the commit `sha` is `commit` (of `repo`) or one of its
+        ancestors.
+        """
+        self.update(repo, commit)
+        target = self.rows.get(sha)
+        if target is None:
+            return False
+        generation = self.generations[target]
+        generations = self.generations
+        seen = set()
+        stack = [self.rows[commit.id]]
+        while stack:
+            row = stack.pop()
+            if row == target:
+                return True
+            # ancestors of the target have lower rows and generations
+            if row < target or generations[row] <= generation or row in seen:
+                continue
+            seen.add(row)
+            stack.extend(self.parents(row))
+        return False
+
+    def walk(self, repo, commit, order='date'):
+        """
+        Yields the rows of `commit` (of `repo`) and all of its ancestors, each
+        after all of its descendants (in `commit`'s history) for the 'topo'
+        `order`, or newest commit time first for 'date' (like ``git log``).
+        """
+        self.update(repo, commit)
+        commit_times = self.commit_times
+        if order == 'topo':
+            key = lambda row: -row
+        else:
+            key = lambda row: (-commit_times[row], -row)
+        start = self.rows[commit.id]
+        queue = [(key(start), start)]
+        seen = set([start])
+        while queue:
+            _, row = heapq.heappop(queue)
+            yield row
+            for parent in self.parents(row):
+                if parent not in seen:
+                    seen.add(parent)
+                    heapq.heappush(queue, (key(parent), parent))
+
+    def history(self, repo, commit, path, order='date', max_commits=None,
+                skip=0):
+        """
+        Returns the shas of the commits of `repo` reachable from `commit` (in
+        `order`, see `walk`) that changed `path`. Merge commits count as
+        changing it if it differs from any of their parents, like with
+        ``git log --full-history``.
+        """
+        if max_commits is None:
+            max_commits = float('inf')
+        shas = []
+        for row in self.walk(repo, commit, order):
+            if len(shas) >= max_commits:
+                break
+            if path and not self._changes(repo, row, path):
+                continue
+            if skip:
+                skip -= 1
+            else:
+                shas.append(self.shas[row])
+        return shas
+
+    def _changes(self, repo, row, path):
+        entry = _entry(repo, self.tree(repo, row), path)
+        parents = self.parents(row)
+        if not parents:
+            return entry is not None
+        return any(_entry(repo, self.tree(repo, parent), path) != entry
+                   for parent in parents)
+
+
+def _entry(repo, tree, path):
+    try:
+        return repo.lookup_tree_path(tree, path)
+    except KeyError:
+        return None
+
+
+def _intersect(candidates, rows):
+    if candidates is None:
+        return set(rows)
+    return candidates.intersection(rows)
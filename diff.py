@@ -10,6 +10,239 @@
 """
 import re
 from cgi import escape
+from bisect import bisect_left
+from difflib import SequenceMatcher
+from collections import namedtuple
+
+from utils import force_unicode
+
+
+# One line of a rendered diff. `line` is HTML.
+DiffLine = namedtuple('DiffLine', 'old_lineno new_lineno action line')
+
+
+def diff_lines(old_lines, new_lines, context=3, max_lines=None):
+    """
+    Diffs two sequences of lines (byte strings without the trailing newline,
+    see `split_lines`) and returns a list of chunks, each a list of
+    `DiffLine`s, like `prepare_udiff` does for unified diffs. Only lines that
+    end up in the diff are decoded and escaped. Modified lines are paired up
+    and their changes highlighted.
+
+    Returns `None` if the diff would have more than `max_lines` lines. That's
+    found out before rendering any lines and, if the numbers of lines differ
+    by more than that, without diffing at all.
+    """
+    if max_lines is not None and abs(len(old_lines) - len(new_lines)) > max_lines:
+        return None
+    blocks = matching_blocks(old_lines, new_lines)
+    codes = opcodes(blocks, len(old_lines), len(new_lines))
+    groups = list(group_opcodes(codes, context))
+    if max_lines is not None and sum(
+            i2 - i1 if tag == 'equal' else i2 - i1 + j2 - j1
+            for group in groups
+            for tag, i1, i2, j1, j2 in group) > max_lines:
+        return None
+    chunks = []
+    for group in groups:
+        lines = []
+        for tag, i1, i2, j1, j2 in group:
+            if tag == 'equal':
+                for i, j in zip(xrange(i1, i2), xrange(j1, j2)):
+                    line = escape(decode_line(old_lines[i]))
+                    lines.append(DiffLine(i+1, j+1, 'unmod', line))
+                continue
+            deleted = [decode_line(line) for line in old_lines[i1:i2]]
+            added = [decode_line(line) for line in new_lines[j1:j2]]
+            if len(deleted) == len(added):
+                for k, (old, new) in enumerate(zip(deleted, added)):
+                    deleted[k], added[k] = highlight_change(old, new)
+            else:
+                deleted = map(escape, deleted)
+                added = map(escape, added)
+            for i, line in enumerate(deleted, i1):
+                lines.append(DiffLine(i+1, u'', 'del', line))
+            for j, line in enumerate(added, j1):
+                lines.append(DiffLine(u'', j+1, 'add', line))
+        chunks.append(lines)
+    return chunks
+
+
+def diff_blobs(old, new, max_lines=None):
+    """ `diff_lines` for the contents of two blobs. """
+    return diff_lines(split_lines(old), split_lines(new), max_lines=max_lines)
+
+
+def split_lines(data):
+    """
+    Returns the lines of `data` without their newlines.
+
+    >>> split_lines('a\\r\\nb\\n')
+    ['a\\r', 'b']
+    """
+    if not data:
+        return []
+    lines = data.split('\n')
+    if not lines[-1]:
+        lines.pop()
+    return lines
+
+
+def decode_line(line):
+    if line.endswith('\r'):
+        line = line[:-1]
+    return force_unicode(line)
+
+
+def matching_blocks(a, b):
+    """
+    Returns a list of `(i, j, n)` triples meaning ``a[i:i+n] == b[j:j+n]``,
+    ascending in `i` and `j`, like `SequenceMatcher.get_matching_blocks` (but
+    without the sentinel). Lines that occur exactly once in both sequences are
+    used as anchors (as in "patience diff"), so difflib only ever sees the
+    (usually tiny) gaps between them.
+    """
+    blocks = []
+    _match(a, b, 0, len(a), 0, len(b), blocks, 0)
+    merged = []
+    for i, j, n in blocks:
+        if merged and merged[-1][0] + merged[-1][2] == i and \
+           merged[-1][1] + merged[-1][2] == j:
+            merged[-1] = (merged[-1][0], merged[-1][1], merged[-1][2] + n)
+        else:
+            merged.append((i, j, n))
+    return merged
+
+
+def _match(a, b, alo, ahi, blo, bhi, blocks, depth):
+    # common prefix and suffix
+    while alo < ahi and blo < bhi and a[alo] == b[blo]:
+        blocks.append((alo, blo, 1))
+        alo += 1
+        blo += 1
+    suffix = 0
+    while alo < ahi and blo < bhi and a[ahi-1] == b[bhi-1]:
+        ahi -= 1
+        bhi -= 1
+        suffix += 1
+    if alo < ahi and blo < bhi:
+        anchors = depth < 20 and _unique_anchors(a, b, alo, ahi, blo, bhi)
+        if anchors:
+            for i, j in anchors:
+                _match(a, b, alo, i, blo, j, blocks, depth+1)
+                blocks.append((i, j, 1))
+                alo, blo = i+1, j+1
+            _match(a, b, alo, ahi, blo, bhi, blocks, depth+1)
+        else:
+            matcher = SequenceMatcher(None, a[alo:ahi], b[blo:bhi])
+            for i, j, n in matcher.get_matching_blocks()[:-1]:
+                blocks.append((alo+i, blo+j, n))
+    if suffix:
+        blocks.append((ahi, bhi, suffix))
+
+
+def _unique_anchors(a, b, alo, ahi, blo, bhi):
+    """
+    Returns the longest ascending sequence of `(i, j)` pairs for which
+    ``a[i] == b[j]`` is unique in both ``a[alo:ahi]`` and ``b[blo:bhi]``.
+    """
+    def unique(seq, lo, hi):
+        index = {}
+        for i in xrange(lo, hi):
+            index[seq[i]] = -1 if seq[i] in index else i
+        return index
+    unique_a = unique(a, alo, ahi)
+    unique_b = unique(b, blo, bhi)
+    pairs = []
+    for i in xrange(alo, ahi):
+        if unique_a[a[i]] == i:
+            j = unique_b.get(a[i], -1)
+            if j >= 0:
+                pairs.append((i, j))
+
+    # longest increasing subsequence of the js (patience sorting)
+    tails, tail_indexes = [], []
+    previous = [None] * len(pairs)
+    for k, (i, j) in enumerate(pairs):
+        pos = bisect_left(tails, j)
+        if pos:
+            previous[k] = tail_indexes[pos-1]
+        if pos == len(tails):
+            tails.append(j)
+            tail_indexes.append(k)
+        else:
+            tails[pos] = j
+            tail_indexes[pos] = k
+    anchors = []
+    k = tail_indexes[-1] if tail_indexes else None
+    while k is not None:
+        anchors.append(pairs[k])
+        k = previous[k]
+    anchors.reverse()
+    return anchors
+
+
+def opcodes(blocks, len_a, len_b):
+    """ Like `SequenceMatcher.get_opcodes` for the output of `matching_blocks`. """
+    i = j = 0
+    codes = []
+    for ai, bj, size in blocks + [(len_a, len_b, 0)]:
+        if i < ai and j < bj:
+            codes.append(('replace', i, ai, j, bj))
+        elif i < ai:
+            codes.append(('delete', i, ai, j, bj))
+        elif j < bj:
+            codes.append(('insert', i, ai, j, bj))
+        i, j = ai + size, bj + size
+        if size:
+            codes.append(('equal', ai, i, bj, j))
+    return codes
+
+
+def group_opcodes(codes, n=3):
+    """ Like `SequenceMatcher.get_grouped_opcodes` for the output of `opcodes`. """
+    if not codes:
+        return
+    codes = list(codes)
+    tag, i1, i2, j1, j2 = codes[0]
+    if tag == 'equal':
+        codes[0] = tag, max(i1, i2-n), i2, max(j1, j2-n), j2
+    tag, i1, i2, j1, j2 = codes[-1]
+    if tag == 'equal':
+        codes[-1] = tag, i1, min(i2, i1+n), j1, min(j2, j1+n)
+    group = []
+    for tag, i1, i2, j1, j2 in codes:
+        if tag == 'equal' and i2 - i1 > 2*n:
+            group.append((tag, i1, min(i2, i1+n), j1, min(j2, j1+n)))
+            yield group
+            group = []
+            i1, j1 = max(i1, i2-n), max(j1, j2-n)
+        group.append((tag, i1, i2, j1, j2))
+    if group and not (len(group) == 1 and group[0][0] == 'equal'):
+        yield group
+
+
+def highlight_change(old, new):
+    """
+    Returns `old` and `new` as HTML with the part that differs between them
+    wrapped in ``<del>`` and ``<ins>``, respectively.
+    """
+    start = 0
+    limit = min(len(old), len(new))
+    while start < limit and old[start] == new[start]:
+        start += 1
+    end = 0
+    limit -= start
+    while end < limit and old[-end-1] == new[-end-1]:
+        end += 1
+    if not start and not end:
+        return escape(old), escape(new)
+    def do(line, tag):
+        stop = len(line) - end
+        return u'%s<%s>%s</%s>%s' % (escape(line[:start]), tag,
+                                     escape(line[start:stop]), tag,
+                                     escape(line[stop:]))
+    return do(old, 'del'), do(new, 'ins')
 
 
 def prepare_udiff(udiff, **kwargs):
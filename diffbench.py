@@ -0,0 +1,95 @@
+""" Compares the old unified-text diff pipeline with `diff.diff_lines` """
+import os
+import sys
+import time
+import random
+import resource
+import cStringIO
+
+import dulwich.patch
+from dulwich.objects import Blob
+from dulwich.object_store import MemoryObjectStore
+
+from diff import prepare_udiff, diff_lines, split_lines
+from utils import force_unicode
+
+def make_commit(files, lines, seed=42):
+    """
+    Returns `files` `(old, new)` blob pairs with `lines` lines each, about a
+    third of which are boring lines like real code has plenty of.
+    """
+    random.seed(seed)
+    boring = ['\n', '    }\n', '}\n', '        return None;\n', '    else {\n']
+    pairs = []
+    for n in xrange(files):
+        old = [random.choice(boring) if random.random() < 0.3 else
+               'line %d of file %d: %s\n' % (i, n, 'x' * random.randint(0, 60))
+               for i in xrange(lines)]
+        new = list(old)
+        for _ in xrange(lines // 20):
+            i = random.randrange(len(new))
+            action = random.choice(['add', 'del', 'mod'])
+            if action == 'add':
+                new.insert(i, 'added line %d\n' % i)
+            elif action == 'del':
+                del new[i]
+            else:
+                new[i] = new[i].replace('x', 'y', 3)
+        pairs.append((Blob.from_string(''.join(old)),
+                      Blob.from_string(''.join(new))))
+    return pairs
+
+def udiff_pipeline(store, pairs):
+    result = []
+    for old, new in pairs:
+        stringio = cStringIO.StringIO()
+        dulwich.patch.write_object_diff(stringio, store,
+                                        ('file', 0100644, old.id),
+                                        ('file', 0100644, new.id))
+        result.append(prepare_udiff(force_unicode(stringio.getvalue()),
+                                    want_header=False))
+    return result
+
+def native_pipeline(store, pairs):
+    return [diff_lines(split_lines(store[old.id].data),
+                       split_lines(store[new.id].data))
+            for old, new in pairs]
+
+def measure(func, *args):
+    """
+    Runs `func(*args)` in a child process. Returns the CPU time it took and
+    how much the peak RSS grew, in KB.
+    """
+    read_end, write_end = os.pipe()
+    pid = os.fork()
+    if not pid:
+        os.close(read_end)
+        rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        start = time.clock()
+        result = func(*args)
+        duration = time.clock() - start
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss_before
+        os.write(write_end, '%f %d' % (duration, rss))
+        os._exit(0)
+    os.close(write_end)
+    duration, rss = os.read(read_end, 100).split()
+    os.close(read_end)
+    os.waitpid(pid, 0)
+    return float(duration), int(rss)
+
+def main():
+    files = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    lines = int(sys.argv[2]) if len(sys.argv) > 2 else 2000
+    pairs = make_commit(files, lines)
+    store = MemoryObjectStore()
+    for old, new in pairs:
+        store.add_object(old)
+        store.add_object(new)
+    print '%d files with %d lines each' % (files, lines)
+    for name, func in [('unified diff + prepare_udiff', udiff_pipeline),
+                       ('diff_lines', native_pipeline)]:
+        duration, rss = measure(func, store, pairs)
+        print '%-30s %8.2fs CPU %8d KB peak RSS growth' % (name, duration, rss)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,210 @@
+"""
+Per-commit diffstats: the number of files changed and lines added and removed.
+
+A commit's diffstat is computed once, from the changes to its first parent's
+tree, and kept in a persistent log per repository. Lists of commits only look
+diffstats up; those not computed yet are left out and handed to a background
+thread, which computes them and then goes on with the commits' ancestors, so
+they're there when the list (or its next page) is shown again.
+
+There's one such thread for all repositories. It only takes up a
+`BACKGROUND_LOAD` share of the time and leaves the diffing to the worker
+processes, if there are any, so it doesn't get in the way of requests. It's
+stopped when the process exits.
+"""
+import os
+import time
+import weakref
+import threading
+import itertools
+import collections
+
+import dulwich.objects
+
+import metrics
+import workers
+from diff import split_lines, matching_blocks
+from cache import RecordLog, repo_cache_dir
+
+# number of diffstats to compute before the records are written to disk
+FLUSH_EVERY = 100
+
+# number of ancestors whose diffstats are computed after the requested ones
+BACKGROUND_DEPTH = int(os.environ.get('KLAUS_DIFFSTAT_BACKGROUND_DEPTH', 1000))
+
+# the lines of bigger files (and binary ones) aren't counted
+MAX_FILE_SIZE = int(os.environ.get('KLAUS_DIFFSTAT_MAX_FILE_SIZE', 1024*1024))
+
+# share of the time the background thread may spend computing diffstats
+BACKGROUND_LOAD = float(os.environ.get('KLAUS_DIFFSTAT_BACKGROUND_LOAD', 0.25))
+
+# set to compute no diffstats at all, e.g. while benchmarking
+BACKGROUND_DISABLED = bool(os.environ.get('KLAUS_NO_BACKGROUND_INDEXING'))
+
+# commits to compute the diffstats of as `(index, weak reference to the
+# repository, commit)` tuples, and the thread doing it. The repositories aren't
+# kept open after the `RepoPool` closed them.
+_queue = collections.deque()
+_queue_lock = threading.Lock()
+_thread = None
+
+# set when the process exits
+_stop = threading.Event()
+
+Diffstat = collections.namedtuple('Diffstat', 'files added removed')
+
+
+def compute_diffstat(repo, commit):
+    """
+    Returns the `Diffstat` of `commit` with respect to its first parent, or
+    `None` if the worker processes were too busy to count the lines or the
+    process is exiting.
+    """
+    files = added = removed = 0
+    for change in repo.commit_changes(commit):
+        if _stop.is_set():
+            return None
+        files += 1
+        _, (oldmode, newmode), (oldsha, newsha) = change
+        old = _data(repo, oldmode, oldsha)
+        new = _data(repo, newmode, newsha)
+        if old is None or new is None:
+            continue
+        counts = workers.pool.run(count_lines, (old, new), lambda: None)
+        if counts is None:
+            return None
+        added += counts[0]
+        removed += counts[1]
+    metrics.count('diffstats_computed')
+    return Diffstat(files, added, removed)
+
+
+def count_lines(old, new):
+    """ Returns the number of lines added and removed from `old` to `new`. """
+    old, new = split_lines(old), split_lines(new)
+    matched = sum(n for _, _, n in matching_blocks(old, new))
+    return len(new) - matched, len(old) - matched
+
+
+def _data(repo, mode, sha):
+    if sha is None:
+        return ''
+    if dulwich.objects.S_ISGITLINK(mode):
+        return 'Subproject commit %s\n' % sha
+    size, is_binary = repo.blob_info(sha)
+    if size > MAX_FILE_SIZE or is_binary:
+        return None
+    return ''.join(repo.open_blob(sha)[1])
+
+
+class DiffstatIndex(object):
+    def __init__(self, path):
+        cache_dir = repo_cache_dir(path)
+        self.log = RecordLog(cache_dir and os.path.join(cache_dir, 'diffstats'))
+        self.lock = threading.Lock()
+        self.diffstats = {}  # sha -> Diffstat
+        self._add_records(self.log.read())
+
+    def get(self, repo, commits):
+        """
+        Returns the `Diffstat`s of `commits` (of `repo`) by sha. Missing ones
+        are computed in the background.
+        """
+        with self.lock:
+            self._add_records(self.log.read())
+            result = dict((commit.id, self.diffstats[commit.id])
+                          for commit in commits if commit.id in self.diffstats)
+        missing = [commit for commit in commits if commit.id not in result]
+        if missing and not BACKGROUND_DISABLED:
+            _enqueue(self, repo, missing)
+        return result
+
+    def _compute(self, repo_ref, commit, ancestors):
+        """
+        Computes the diffstat of `commit` and, with `ancestors`, those of its
+        ancestors until other commits are queued.
+        """
+        shas = [commit.id]
+        if ancestors:
+            repo = repo_ref()
+            if repo is None:
+                return
+            index = repo.commit_index
+            rows = index.walk(repo, commit, 'date')
+            shas = [index.shas[row]
+                    for row in itertools.islice(rows, BACKGROUND_DEPTH + 1)]
+            del repo, rows
+        records = []
+        try:
+            for i, sha in enumerate(shas):
+                if _stop.is_set() or (i and _queue):
+                    break
+                if sha in self.diffstats:
+                    continue
+                repo = repo_ref()
+                if repo is None:
+                    # closed; its commits are queued again when it's browsed
+                    break
+                start = time.time()
+                diffstat = compute_diffstat(repo, repo[sha])
+                del repo
+                if diffstat is not None:
+                    records.append((sha,) + diffstat)
+                    with self.lock:
+                        self._add_record(*records[-1])
+                        if len(records) >= FLUSH_EVERY:
+                            self._add_records(self.log.append(records))
+                            records = []
+                # pause to keep to `BACKGROUND_LOAD`, or until exiting
+                _stop.wait((time.time() - start) * (1 / BACKGROUND_LOAD - 1))
+        finally:
+            with self.lock:
+                self._add_records(self.log.append(records))
+
+    def _add_records(self, records):
+        for record in records:
+            self._add_record(*record)
+
+    def _add_record(self, sha, files, added, removed):
+        self.diffstats[sha] = Diffstat(files, added, removed)
+
+
+def _enqueue(index, repo, commits):
+    global _thread
+    repo_ref = weakref.ref(repo)
+    with _queue_lock:
+        if _stop.is_set():
+            return
+        _queue.extend((index, repo_ref, commit) for commit in commits)
+        if _thread is None:
+            _thread = threading.Thread(target=_run, name='diffstats')
+            _thread.daemon = True
+            _thread.start()
+
+def _run():
+    global _thread
+    try:
+        while True:
+            with _queue_lock:
+                if not _queue or _stop.is_set():
+                    # under the lock, so `_enqueue` starts a new thread for
+                    # anything it queues from now on
+                    _thread = None
+                    return
+                index, repo_ref, commit = _queue.popleft()
+                # the requested commits first, then, once no one is waiting,
+                # the ancestors of the last one
+                ancestors = not _queue
+            index._compute(repo_ref, commit, ancestors)
+    except Exception:
+        with _queue_lock:
+            _thread = None
+        raise
+
+
+@workers.on_exit
+def _stop_threads():
+    _stop.set()
+    thread = _thread
+    if thread is not None:
+        thread.join(5)
@@ -0,0 +1,167 @@
+"""
+Persistent index of first-parent history.
+
+For every indexed commit we keep its first parent, its depth (distance from
+the root commit) and a "jump" pointer to some further ancestor (the skew-binary
+scheme from Myers' "An applicative random-access stack"), which allows finding
+the ancestor at any depth in O(log n) steps without loading any commits.
+
+For every path and every directory above it we keep a depth-sorted list of the
+commits that changed it with respect to their first parent, so the history of
+a path can be answered by looking at these commits only.
+"""
+import os
+import threading
+from bisect import bisect_right
+
+from cache import RecordLog, repo_cache_dir
+
+# number of commits to index before the records are written to disk
+FLUSH_EVERY = 1000
+
+
+def path_prefixes(path):
+    """
+    >>> path_prefixes('a/b/c')
+    ['a', 'a/b', 'a/b/c']
+    """
+    parts = path.split('/')
+    return ['/'.join(parts[:i]) for i in xrange(1, len(parts)+1)]
+
+
+class HistoryIndex(object):
+    def __init__(self, path):
+        cache_dir = repo_cache_dir(path)
+        self.log = RecordLog(cache_dir and os.path.join(cache_dir, 'history'))
+        self.lock = threading.Lock()
+        # sha -> (first parent sha or None, depth, jump sha)
+        self.commits = {}
+        # path -> ([depth, ...], [sha, ...]), sorted by depth
+        self.postings = {}
+        self._add_records(self.log.read())
+
+    def __contains__(self, sha):
+        return sha in self.commits
+
+    def history(self, repo, commit, path, max_commits=None, skip=0, after=None):
+        """
+        Returns the shas of the commits of `repo` that changed `path`, starting
+        at `commit` and walking down its first-parent chain. If `after` is
+        given, the walk resumes below that commit.
+        """
+        self.update(repo, commit)
+        if max_commits is None:
+            max_commits = float('inf')
+        with self.lock:
+            sha = commit.id
+            depth = self.commits[sha][1]
+            shas = []
+            if after is not None:
+                if after not in self.commits:
+                    return shas
+                depth = min(depth, self.commits[after][1] - 1)
+            if not path:
+                depth -= skip
+                if depth < 0:
+                    return shas
+                sha = self.ancestor_at(sha, depth)
+                while sha is not None and len(shas) < max_commits:
+                    shas.append(sha)
+                    sha = self.commits[sha][0]
+                return shas
+            depths, candidates = self.postings.get(path, ((), ()))
+            i = bisect_right(depths, depth)
+            while i > 0 and len(shas) < max_commits:
+                i -= 1
+                if self.ancestor_at(sha, depths[i]) != candidates[i]:
+                    # changed on some other branch
+                    continue
+                if skip:
+                    skip -= 1
+                else:
+                    shas.append(candidates[i])
+            return shas
+
+    def ancestor_at(self, sha, depth):
+        """ Returns the first-parent ancestor of `sha` at `depth`. """
+        commits = self.commits
+        parent, current, jump = commits[sha]
+        while current > depth:
+            if commits[jump][1] >= depth:
+                sha = jump
+            else:
+                sha = parent
+            parent, current, jump = commits[sha]
+        return sha
+
+    def update(self, repo, commit):
+        """
+        Indexes `commit` (of `repo`) and all of its first-parent ancestors that
+        aren't indexed yet. This is cheap if the commit has already been
+        indexed.
+        """
+        if commit.id in self.commits:
+            return
+        with self.lock:
+            self._add_records(self.log.read())
+            new = []
+            for commit in repo._history(commit):
+                if commit.id in self.commits:
+                    break
+                new.append(commit)
+            records = []
+            for commit in reversed(new):
+                if commit.parents:
+                    parent = commit.parents[0]
+                    parent_tree = repo[parent].tree
+                else:
+                    parent = parent_tree = None
+                changes = repo.object_store.tree_changes(parent_tree, commit.tree)
+                paths = set()
+                for (oldpath, newpath), _, _ in changes:
+                    paths.add(oldpath)
+                    paths.add(newpath)
+                paths.discard(None)
+                record = (commit.id, parent, tuple(paths))
+                self._add_record(*record)
+                records.append(record)
+                if len(records) >= FLUSH_EVERY:
+                    self._add_records(self.log.append(records))
+                    records = []
+            self._add_records(self.log.append(records))
+
+    def _add_records(self, records):
+        for record in records:
+            try:
+                self._add_record(*record)
+            except KeyError:
+                # parent unknown, e.g. because of a lost write. The commit
+                # will be indexed again when it is needed.
+                pass
+
+    def _add_record(self, sha, parent, paths):
+        commits = self.commits
+        if sha in commits:
+            return
+        if parent is None:
+            depth, jump = 0, sha
+        else:
+            _, parent_depth, parent_jump = commits[parent]
+            _, jump_depth, jump_jump = commits[parent_jump]
+            depth = parent_depth + 1
+            if parent_depth - jump_depth == jump_depth - commits[jump_jump][1]:
+                jump = jump_jump
+            else:
+                jump = parent
+        commits[sha] = (parent, depth, jump)
+
+        seen = set()
+        for path in paths:
+            for prefix in path_prefixes(path):
+                if prefix in seen:
+                    continue
+                seen.add(prefix)
+                depths, shas = self.postings.setdefault(prefix, ([], []))
+                i = bisect_right(depths, depth)
+                depths.insert(i, depth)
+                shas.insert(i, sha)
@@ -1,11 +1,28 @@
+import re
 import sys
 import os
+import stat
+import time
+import calendar
+import hashlib
+import itertools
+import mimetypes
 
-from jinja2 import Environment, FileSystemLoader
-from flask import Flask, request, session, g, redirect, url_for, abort, render_template, flash
+import dulwich.objects, dulwich.errors
+from jinja2 import Environment, FileSystemLoader, FileSystemBytecodeCache
+from flask import Flask, request, session, g, redirect, url_for, abort, render_template, flash, stream_with_context
 
-from repo import Repo
-from utils import timesince, pygmentize, force_unicode, guess_is_binary, guess_is_image, extract_author_name, subpaths, get_commit, listdir, get_blob, shorten_sha1
+import metrics
+import registry
+import diffstat
+from repo import Repo, repo_summaries
+from archive import tar_gz_archive, zip_archive
+from searchindex import search
+from blame import blame
+from commitindex import ORDERS
+from diff import split_lines, decode_line
+from cache import FileCache, cache_dir, caches
+from utils import timesince, pygmentize, force_unicode, guess_is_binary, guess_is_image, extract_author_name, subpaths, get_commit, listdir, shorten_sha1, slice_chunks
 
 
 
@@ -18,6 +35,7 @@ except IOError:
     KLAUS_VERSION = ''
 
 app = application = Flask(__name__, template_folder=TEMPLATE_DIR)
+render_template = metrics.timed('render')(render_template)
 app.jinja_env.filters['u'] = force_unicode
 app.jinja_env.filters['timesince'] = timesince
 app.jinja_env.filters['shorten_sha1'] = shorten_sha1
@@ -28,23 +46,31 @@ app.jinja_env.filters['is_image'] = guess_is_image
 app.jinja_env.filters['shorten_author'] = extract_author_name
 app.jinja_env.globals['KLAUS_VERSION'] = KLAUS_VERSION
 app.debug = bool(os.environ.get('KLAUS_DEBUG', 'False'))
+# compiled templates, so new worker processes needn't compile them again
+JINJA_CACHE_DIR = cache_dir('jinja')
+if JINJA_CACHE_DIR is not None:
+    app.jinja_env.bytecode_cache = FileSystemBytecodeCache(JINJA_CACHE_DIR)
 
-if os.path.isfile(os.path.join(os.environ.get('KLAUS_BASE_PATH', ''), 'projects.list')):
-    app.repos={}
-    f=open(os.path.join(os.environ.get('KLAUS_BASE_PATH', ''), 'projects.list'), 'r')
-    for line in f.readlines():
-        app.repos[line.strip().rstrip(os.sep)] = os.environ.get('KLAUS_BASE_PATH', '') + os.environ.get('KLAUS_BASE_PATH_SUFFIX', '') + line.strip()
-    f.close()
-else:
-    app.repos = {repo.rstrip(os.sep): (os.environ.get('KLAUS_BASE_PATH', '') + repo) for repo in os.environ.get('KLAUS_REPOS', '').split()}
+app.repos = registry.from_environ(app.logger)
 
 def get_repo(name):
     try:
         return Repo(name, app.repos[name])
-    except KeyError:
+    except (KeyError, dulwich.errors.NotGitRepository):
         g.err_msg='No repository named "%s"' % name
         abort(404)
 
+# Requests with an `X-PJAX` header (sent by static/klaus.js) get only the
+# parts of the page that change when navigating inside a repository. The tree
+# listing is left out, too, if the `X-PJAX-Tree` header says the client
+# already shows it.
+def is_pjax():
+    return 'X-PJAX' in request.headers
+
+@app.context_processor
+def add_layout():
+    return {'layout': 'fragment.html' if is_pjax() else 'skeleton.html'}
+
 # now load some stuff..
 @app.url_value_preprocessor
 def pull_stuff(endpoint, values):
@@ -83,23 +109,86 @@ def add_commit_id(endpoint, values):
     if app.url_map.is_endpoint_expecting(endpoint, 'commit_id'):
         values['commit_id'] = g.commit_id
 
+# conditional requests. Views of full shas never change, everything else is
+# identified by the commit the branch currently points to. HTML pages show the
+# branch list, too, so they're only cached until it changes.
+SHA1_RE = re.compile('^[0-9a-f]{40}$')
+
+@app.before_request
+def check_etag():
+    if getattr(g, 'commit', None) is None:
+        return
+    key = '\0'.join([KLAUS_VERSION, request.path.encode('utf-8'),
+                     request.query_string, g.commit.id, str(is_pjax()),
+                     request.headers.get('X-PJAX-Tree', ''),
+                     ' '.join(g.branches)])
+    g.etag = hashlib.sha1(key).hexdigest()
+    g.immutable = SHA1_RE.match(g.commit_id) is not None
+    if g.etag in request.if_none_match:
+        return app.response_class(status=304)
+
+@app.after_request
+def add_cache_headers(response):
+    response.vary.add('X-PJAX')
+    response.vary.add('X-PJAX-Tree')
+    if getattr(g, 'etag', None) is None or response.status_code not in (200, 206, 304):
+        return response
+    if getattr(g, 'incomplete', False):
+        response.headers['Cache-Control'] = 'no-store'
+        return response
+    response.set_etag(g.etag)
+    if g.immutable and response.mimetype != 'text/html':
+        response.headers['Cache-Control'] = 'public, max-age=31536000'
+    else:
+        response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+def diffstats(commits):
+    """
+    `RepoWrapper.diffstats` for templates. Pages missing some of them aren't
+    cached, so they show them once they have been computed. (Unless they're
+    never computed because background indexing is turned off.)
+    """
+    result = g.repo.diffstats(commits)
+    if len(result) < len(commits) and not diffstat.BACKGROUND_DISABLED:
+        g.incomplete = True
+    return result
+app.jinja_env.filters['diffstats'] = diffstats
+
+if metrics.ENABLED:
+    def start_request(wsgi_app):
+        def start_request(environ, start_response):
+            metrics.start_request()
+            return wsgi_app(environ, start_response)
+        return start_request
+    app.wsgi_app = start_request(app.wsgi_app)
+
+    @app.after_request
+    def add_server_timing(response):
+        response.headers['Server-Timing'] = metrics.server_timing()
+        return response
+
+    @app.teardown_request
+    def finish_request(exception):
+        metrics.finish_request(request.endpoint)
+
+    @app.route('/_metrics')
+    def view_metrics():
+        return app.response_class(metrics.render(caches),
+                                  content_type='text/plain; version=0.0.4')
+
 @app.errorhandler(404)
 def view_page_not_found(error):
     return render_template('page_not_found.html'), 404
 
 @app.route('/')
 def view_repo_list():
-    repos = []
-    for name in app.repos.iterkeys():
-        repo = get_repo(name)
-        refs = [repo[ref] for ref in repo.get_refs()]
-        refs.sort(key=lambda obj:getattr(obj, 'commit_time', None), reverse=True)
-        if len(refs) > 0:
-            repos.append((name, refs[0].commit_time))
+    repos = [summary for summary in repo_summaries(app.repos.iteritems(), app.logger)
+             if summary.last_updated is not None]
     if 'by-last-update' in request.args:
-        repos.sort(key=lambda x: x[1], reverse=True)
+        repos.sort(key=lambda summary: summary.last_updated, reverse=True)
     else:
-        repos.sort(key=lambda x: x[0])
+        repos.sort(key=lambda summary: summary.name)
     return render_template("repo_list.html", repos=repos)
 
 @app.route('/<path:repo>/tree/<string:commit_id>/')
@@ -112,9 +201,18 @@ def view_history(path=None):
     except (TypeError, ValueError):
         page = 0
     
+    # 'date' or 'topo' to include commits from merged branches
+    order = request.args.get('order')
+    if order not in ORDERS:
+        order = None
+
+    # the sha of the last commit on the previous page. Resuming the walk from
+    # there is much cheaper than skipping over all previous pages.
+    after = None if order else request.args.get('after')
+
     if page:
         history_length = 30
-        skip = (page-1) * 30 + 10
+        skip = 0 if after else (page-1) * 30 + 10
         if page > 7:
             previous_pages = [0, 1, 2, None] + range(page)[-3:]
         else:
@@ -123,42 +221,354 @@ def view_history(path=None):
         history_length = 10
         skip = 0
         previous_pages=None
-    return render_template('history.html', page=page, history_length=history_length, skip=skip, tree=tree, previous_pages=previous_pages)
+    return render_template('history.html', page=page, history_length=history_length, skip=skip, after=after, order=order, tree=tree, previous_pages=previous_pages)
+
+@app.route('/<path:repo>/log/<string:commit_id>')
+def view_log():
+    """
+    Commits by `author`, committed `since` and `until` (inclusive, as
+    YYYY-MM-DD), whose message contains the words `q` and that changed `path`.
+    """
+    try:
+        page = int(request.args.get('page'))
+    except (TypeError, ValueError):
+        page = 0
+    filters = dict((name, request.args.get(name, u'').strip())
+                   for name in ['author', 'since', 'until', 'q', 'path'])
+    error = None
+    dates = {}
+    for name in ['since', 'until']:
+        if filters[name]:
+            try:
+                dates[name] = calendar.timegm(time.strptime(filters[name], '%Y-%m-%d'))
+            except ValueError:
+                error = 'Dates must be given as YYYY-MM-DD.'
+    if 'until' in dates:
+        dates['until'] += 24*60*60
+
+    commits = []
+    if not error:
+        commits = g.repo.search_commits(
+            g.commit, filters['path'].encode('utf-8'), filters['author'],
+            dates.get('since'), dates.get('until'), filters['q'],
+            LOG_PAGE_LENGTH + 1, page * LOG_PAGE_LENGTH)
+    tree = listdir(g.repo, g.commit, '')
+    # for the pagination links
+    query_args = dict((name, value) for name, value in filters.iteritems() if value)
+    return render_template('log.html', commits=commits[:LOG_PAGE_LENGTH],
+                           has_more_commits=len(commits) > LOG_PAGE_LENGTH,
+                           page=page, filters=filters, query_args=query_args,
+                           error=error, tree=tree)
+
+LOG_PAGE_LENGTH = 30
 
 @app.route('/<path:repo>/blob/<string:commit_id>/<path:path>')
 def view_blob(path):
+    try:
+        mode, sha = g.repo.lookup_path(g.commit, g.path)
+    except KeyError:
+        abort(404)
+    if stat.S_ISDIR(mode):
+        return redirect(url_for('view_history', path=g.path))
     tree=listdir(g.repo, g.commit, g.path)
-    blob=get_blob(g.repo, g.commit, g.path)
     raw_url = url_for('view_raw_blob', path=g.path)
-    too_large = sum(map(len, blob.chunked)) > 100*1024
-    return render_template('view_blob.html', blob=blob, raw_url=raw_url, too_large=too_large, tree=tree)
+    # binary blobs aren't shown, so don't even load them
+    size, is_binary = g.repo.blob_info(sha)
+    blob = window = None
+    if not is_binary:
+        if size > BLOB_WINDOW_THRESHOLD or 'lines' in request.args:
+            window = blob_window(sha)
+        else:
+            blob = g.repo[sha]
+    return render_template('view_blob.html', blob=blob, window=window, is_binary=is_binary, raw_url=raw_url, tree=tree)
+
+# Blobs bigger than this (or any blob if `?lines=first-last` is given) are
+# shown in windows of `BLOB_WINDOW_LINES` lines, at most `BLOB_MAX_WINDOW_LINES`.
+BLOB_WINDOW_THRESHOLD = int(os.environ.get('KLAUS_BLOB_WINDOW_THRESHOLD', 100*1024))
+BLOB_WINDOW_LINES = int(os.environ.get('KLAUS_BLOB_WINDOW_LINES', 1000))
+BLOB_MAX_WINDOW_LINES = int(os.environ.get('KLAUS_BLOB_MAX_WINDOW_LINES', 10000))
+
+def blob_window(sha):
+    """
+    Returns a dict with the highlighted HTML of the lines requested by the
+    `lines` argument of the blob `sha`, plus the line numbers of the window
+    and of the previous and next windows.
+    """
+    # imported here since it loads Pygments, which most views don't need
+    from blobwindow import highlight_window
+    index, read = blob_line_index(sha)
+    start, stop, window = line_window(index.line_count)
+    if index.line_count:
+        window['html'] = highlight_window(index, read, start, stop)
+    else:
+        window['html'] = u''
+    return window
+
+def blob_line_index(sha):
+    """
+    Returns the `LineIndex` of the blob `sha` and a function `read(start,
+    stop)` that returns the given byte range of the blob.
+    """
+    # the whole blob once it has been loaded to build the line index, so it
+    # isn't read (or decompressed) again
+    data = []
+    def load_data():
+        if not data:
+            data.append(''.join(g.repo.open_blob(sha)[1]))
+        return data[0]
+    def read(start, stop):
+        # `open_blob` decompresses (most) blobs while iterating, so this
+        # stops at `stop`
+        if data:
+            return data[0][start:stop]
+        return ''.join(slice_chunks(g.repo.open_blob(sha)[1], start, stop))
+    from blobwindow import get_line_index
+    return get_line_index(sha, g.filename, load_data), read
+
+def line_window(line_count):
+    """
+    Returns the `(start, stop)` (zero-based, exclusive) of the window of lines
+    requested by the `lines` argument of a file of `line_count` lines, plus a
+    dict with the line numbers of the window and of the previous and next
+    windows.
+    """
+    match = re.match(r'^(\d+)-(\d+)$', request.args.get('lines', ''))
+    if match:
+        first, last = map(int, match.groups())
+        start = max(first, 1) - 1
+        stop = min(max(last, first), start + BLOB_MAX_WINDOW_LINES)
+    else:
+        start, stop = 0, BLOB_WINDOW_LINES
+    start = min(start, max(line_count - 1, 0))
+    stop = min(max(stop, start + 1), line_count)
+    length = stop - start
+
+    window = {'first': start + 1, 'last': stop, 'line_count': line_count}
+    if start > 0:
+        window['previous'] = '%d-%d' % (max(start - length, 0) + 1, start)
+    if stop < line_count:
+        window['next'] = '%d-%d' % (stop + 1, min(stop + length, line_count))
+    return start, stop, window
+
+
+@app.route('/<path:repo>/blame/<string:commit_id>/<path:path>')
+def view_blame(path):
+    try:
+        mode, sha = g.repo.lookup_path(g.commit, g.path)
+    except KeyError:
+        abort(404)
+    if stat.S_ISDIR(mode):
+        return redirect(url_for('view_history', path=g.path))
+    tree = listdir(g.repo, g.commit, g.path)
+    size, is_binary = g.repo.blob_info(sha)
+    lines = window = None
+    if not is_binary:
+        if size > BLOB_WINDOW_THRESHOLD or 'lines' in request.args:
+            # only the window's lines are read
+            index, read = blob_line_index(sha)
+            start, stop, window = line_window(index.line_count)
+            file_lines = split_lines(read(index.offsets[start], index.offsets[stop]))
+        else:
+            file_lines = split_lines(''.join(g.repo.open_blob(sha)[1]))
+            start, stop = 0, len(file_lines)
+        path = '/'.join(name for name in g.path.split('/') if name)
+        try:
+            shas = blame(g.repo, g.commit, path, start, stop)
+        except KeyError:
+            abort(404)
+        commits = dict((sha, g.repo[sha]) for sha in set(shas))
+        # `(line number, commit or None if it's the same as above, line)`
+        lines = [(start + i + 1, commits[sha] if i == 0 or shas[i-1] != sha else None,
+                  decode_line(file_lines[i]))
+                 for i, sha in enumerate(shas)]
+    return render_template('blame.html', lines=lines, window=window,
+                           is_binary=is_binary, tree=tree)
 
 
 @app.route('/<path:repo>/raw/<string:commit_id>/<path:path>')
-def view_raw_blob(self):
-    mime, encoding = self.get_mimetype_and_encoding()
-    headers = {'Content-Type': mime}
+def view_raw_blob(path):
+    try:
+        mode, sha = g.repo.lookup_path(g.commit, g.path)
+    except (KeyError, TypeError):
+        abort(404)
+    if stat.S_ISDIR(mode):
+        abort(404)
+    # blobs are content-addressed, so the sha is as good an ETag as any
+    g.etag = sha
+    if sha in request.if_none_match:
+        return app.response_class(status=304)
+
+    # the range is checked before the blob is opened
+    size, _ = g.repo.blob_info(sha)
+    status = 200
+    headers = {'Accept-Ranges': 'bytes'}
+    start, stop = 0, size
+    requested_range = request.range
+    # an If-Range date can't be checked (there's no Last-Modified), so the
+    # whole blob is sent then
+    if requested_range is not None and len(requested_range.ranges) == 1 and \
+       ('If-Range' not in request.headers or request.if_range.etag == sha):
+        start_stop = requested_range.range_for_length(size)
+        if start_stop is None:
+            return app.response_class(status=416, headers={
+                'Content-Range': 'bytes */%d' % size
+            })
+        start, stop = start_stop
+        status = 206
+        headers['Content-Range'] = requested_range.to_content_range_header(size)
+    headers['Content-Length'] = str(stop - start)
+
+    _, chunks = g.repo.open_blob(sha)
+    first_chunk = next(chunks, '')
+    chunks = itertools.chain([first_chunk], chunks)
+    mime, encoding = get_mimetype_and_encoding(first_chunk[:8000], g.filename)
     if encoding:
-        headers['Content-Encoding'] = encoding
-        body = self['blob'].chunked
-    if len(body) == 1 and not body[0]:
-        body = []
-    self.direct_response('200 yo', headers, body)
+        mime += '; charset=' + encoding
+
+    return app.response_class(slice_chunks(chunks, start, stop), status,
+                              headers, content_type=mime,
+                              direct_passthrough=True)
 
 
-def get_mimetype_and_encoding(blob, filename):
-    if guess_is_binary(blob.chunked):
+def get_mimetype_and_encoding(data, filename):
+    if guess_is_binary(data):
         mime, encoding = mimetypes.guess_type(filename)
-        if mime is None:
-            mime = 'appliication/octet-stream'
-        return mime, encoding
+        if mime is None or encoding is not None:
+            # serve compressed files as they are
+            mime = 'application/octet-stream'
+        return mime, None
     else:
         return 'text/plain', 'utf-8'
 
 
+# Finished archives are kept on disk (if `KLAUS_CACHE_DIR` is set), using up
+# to `KLAUS_ARCHIVE_CACHE_SIZE` bytes. They depend on the commit and on the
+# name of their top-level directory.
+archive_cache = FileCache(cache_dir('archives'),
+                          int(os.environ.get('KLAUS_ARCHIVE_CACHE_SIZE', 1024**3)))
+ARCHIVE_FORMATS = {
+    'tar.gz': (tar_gz_archive, 'application/x-gzip'),
+    'zip': (zip_archive, 'application/zip'),
+}
+
+@app.route('/<path:repo>/archive/<string:commit_id>.tar.gz', defaults={'format': 'tar.gz'})
+@app.route('/<path:repo>/archive/<string:commit_id>.zip', defaults={'format': 'zip'})
+def view_archive(format):
+    archive, mime = ARCHIVE_FORMATS[format]
+    prefix = '%s-%s' % (os.path.basename(g.repo.name.rstrip('/')),
+                        g.commit_id.replace('/', '-'))
+    headers = {
+        'Content-Disposition': 'attachment; filename="%s.%s"' % (prefix, format)
+    }
+    key = '%s-%s.%s' % (g.commit.id,
+                        hashlib.sha1(prefix.encode('utf-8')).hexdigest(), format)
+    path = archive_cache.get(key)
+    if path is not None:
+        headers['Content-Length'] = str(os.path.getsize(path))
+        return app.response_class(file_chunks(path), headers=headers,
+                                  content_type=mime, direct_passthrough=True)
+
+    repo, commit = g.repo, g.commit
+    def entries():
+        for path, mode, sha in repo.walk_tree(commit):
+            if dulwich.objects.S_ISGITLINK(mode):
+                continue
+            size, chunks = repo.open_blob(sha)
+            yield prefix.encode('utf-8') + '/' + path, mode, size, chunks
+    chunks = archive(entries(), commit.commit_time)
+    return app.response_class(archive_cache.tee(key, chunks), headers=headers,
+                              content_type=mime, direct_passthrough=True)
+
+def file_chunks(path, chunk_size=64*1024):
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), ''):
+            yield chunk
+
+
+@app.route('/<path:repo>/search/<string:commit_id>')
+def view_search():
+    query = request.args.get('q', u'')
+    results = None
+    if query:
+        results = search(g.repo, g.commit, query.encode('utf-8'))
+        if results['indexed'] is not None:
+            # the index is still being built, so there might be more results
+            g.incomplete = True
+    tree = listdir(g.repo, g.commit, '')
+    return render_template('search.html', query=query, results=results, tree=tree)
+
+
 @app.route('/<path:repo>/commit/<string:commit_id>/')
 def view_commit():
-    return render_template('view_commit.html')
+    files = budgeted_diff(g.repo, g.commit)
+    return stream_template('view_commit.html', files=files)
+
+@app.route('/<path:repo>/commit/<string:commit_id>/<path:path>')
+def view_commit_file(path):
+    path = g.path.encode('utf-8')
+    for change in g.repo.commit_changes(g.commit):
+        if path in change[0]:
+            files = [g.repo.file_diff(change)]
+            return stream_template('view_commit.html', files=files)
+    g.err_msg = '"%s" was not changed in %s' % (g.path, g.commit.id)
+    abort(404)
+
+
+# Diffs with more lines than this are replaced by a link to the file's diff
+DIFF_FILE_LINES = int(os.environ.get('KLAUS_DIFF_FILE_LINES', 2000))
+# ... as are all diffs after this many lines were shown on a commit page
+DIFF_COMMIT_LINES = int(os.environ.get('KLAUS_DIFF_COMMIT_LINES', 20000))
+
+def budgeted_diff(repo, commit):
+    """
+    Yields the file diffs of `commit`. Files whose diff would exceed the line
+    budgets are collapsed into placeholders; their diffs aren't rendered.
+    """
+    lines_left = DIFF_COMMIT_LINES
+    for change in repo.commit_changes(commit):
+        if lines_left > 0:
+            file = repo.file_diff(change, min(DIFF_FILE_LINES, lines_left))
+            if file['chunks'] is not None:
+                lines_left -= sum(map(len, file['chunks']))
+                yield file
+                continue
+        (oldpath, newpath), _, _ = change
+        yield {
+            'collapsed': True,
+            'old_filename': oldpath or '/dev/null',
+            'new_filename': newpath or '/dev/null',
+            'path': newpath or oldpath,
+            'chunks': []
+        }
+
+
+# Streamed responses are sent in pieces of (at least) this many characters
+# or wherever a template calls `flush()`.
+STREAM_BUFFER_SIZE = 8*1024
+
+def stream_template(template_name, **context):
+    """ Like `render_template`, but streams the output to the client. """
+    flushes = []
+    context['flush'] = lambda: flushes.append(True) or ''
+    app.update_template_context(context)
+    template = app.jinja_env.get_template(template_name)
+
+    def generate():
+        buffer, size = [], 0
+        pieces = template.generate(context)
+        while True:
+            with metrics.timer('render'):
+                piece = next(pieces, None)
+            if piece is None:
+                break
+            buffer.append(piece)
+            size += len(piece)
+            if size >= STREAM_BUFFER_SIZE or flushes:
+                yield u''.join(buffer)
+                buffer, size = [], 0
+                del flushes[:]
+        yield u''.join(buffer)
+    return app.response_class(stream_with_context(generate()))
 
 if __name__ == '__main__':
     app.run(debug=True)
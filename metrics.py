@@ -0,0 +1,184 @@
+"""
+Optional per-request instrumentation, enabled by setting ``KLAUS_METRICS``.
+
+The time a request spends in each stage (object store reads, tree lookups,
+history queries, highlighting, diffing, template rendering) and counters like
+the number of objects read are sent in a ``Server-Timing`` header and
+aggregated into histograms that ``/_metrics`` exposes in Prometheus' text
+format. Metrics are kept per process.
+
+Stages nest (rendering a template includes highlighting the code in it), and
+each stage is timed inclusively. For streamed responses, the header only
+covers the work done before the first piece was sent.
+
+When disabled, `timed` returns functions unchanged and `timer` and `count`
+do nothing.
+"""
+import os
+import time
+import threading
+import collections
+from functools import wraps
+
+ENABLED = bool(os.environ.get('KLAUS_METRICS'))
+
+# upper bounds (in seconds) of the histograms' buckets
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10,
+           float('inf'))
+
+_local = threading.local()
+_lock = threading.Lock()
+# (metric, label name, label value) -> [count per bucket, sum]
+_histograms = {}
+# counter name -> total of all requests
+_counters = collections.defaultdict(int)
+
+
+class Request(object):
+    def __init__(self):
+        self.start = time.time()
+        self.timings = collections.OrderedDict()
+        self.counters = collections.defaultdict(int)
+        self.active = set()
+
+
+def start_request():
+    _local.request = Request()
+
+
+def finish_request(endpoint):
+    """ Adds the current request's timings and counters to the totals. """
+    request = getattr(_local, 'request', None)
+    if request is None:
+        return
+    _local.request = None
+    duration = time.time() - request.start
+    with _lock:
+        _observe('klaus_request_seconds', 'endpoint', endpoint or 'none', duration)
+        for stage, seconds in request.timings.iteritems():
+            _observe('klaus_stage_seconds', 'stage', stage, seconds)
+        for name, n in request.counters.iteritems():
+            # `render` reports the caches' own (process-wide) statistics
+            if not name.endswith(('_cache_hits', '_cache_misses')):
+                _counters[name] += n
+
+
+def _observe(metric, label, value, seconds):
+    key = (metric, label, value)
+    histogram = _histograms.get(key)
+    if histogram is None:
+        histogram = _histograms[key] = [[0] * len(BUCKETS), 0.0]
+    for i, bound in enumerate(BUCKETS):
+        if seconds <= bound:
+            histogram[0][i] += 1
+    histogram[1] += seconds
+
+
+def server_timing():
+    """ Returns the ``Server-Timing`` header for the current request. """
+    request = getattr(_local, 'request', None)
+    if request is None:
+        return None
+    entries = ['%s;dur=%.1f' % (stage, seconds * 1000)
+               for stage, seconds in request.timings.iteritems()]
+    entries.extend('%s;desc="%d"' % item
+                   for item in sorted(request.counters.iteritems()))
+    entries.append('total;dur=%.1f' % ((time.time() - request.start) * 1000))
+    return ', '.join(entries)
+
+
+class _Timer(object):
+    def __init__(self, stage):
+        self.stage = stage
+        self.request = None
+
+    def __enter__(self):
+        request = getattr(_local, 'request', None)
+        # recursive calls are part of the outermost one
+        if request is not None and self.stage not in request.active:
+            request.active.add(self.stage)
+            self.request = request
+            self.start = time.time()
+
+    def __exit__(self, *exc_info):
+        request = self.request
+        if request is not None:
+            request.timings[self.stage] = request.timings.get(self.stage, 0) + \
+                                          time.time() - self.start
+            request.active.discard(self.stage)
+
+
+class _NullTimer(object):
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc_info):
+        pass
+
+_null_timer = _NullTimer()
+
+
+def timer(stage):
+    """ Returns a context manager that adds the time spent in it to `stage`. """
+    if not ENABLED:
+        return _null_timer
+    return _Timer(stage)
+
+
+def timed(stage):
+    """ Decorator that adds the time spent in a function to `stage`. """
+    def decorator(func):
+        if not ENABLED:
+            return func
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with _Timer(stage):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def count(name, n=1):
+    """ Adds `n` to the current request's counter `name`. """
+    if ENABLED:
+        request = getattr(_local, 'request', None)
+        if request is not None:
+            request.counters[name] += n
+
+
+def render(caches):
+    """
+    Returns all metrics in Prometheus' text format. `caches` maps names to
+    `LRUCache`s whose statistics are included.
+    """
+    lines = []
+    with _lock:
+        for metric, help in [
+            ('klaus_request_seconds', 'Duration of requests by endpoint.'),
+            ('klaus_stage_seconds', 'Time requests spent in each stage.'),
+        ]:
+            lines.append('# HELP %s %s' % (metric, help))
+            lines.append('# TYPE %s histogram' % metric)
+            for (name, label, value), (buckets, total) in sorted(_histograms.iteritems()):
+                if name != metric:
+                    continue
+                for bound, n in zip(BUCKETS, buckets):
+                    lines.append('%s_bucket{%s="%s",le="%s"} %d' % (
+                        metric, label, value,
+                        '+Inf' if bound == float('inf') else bound, n))
+                lines.append('%s_sum{%s="%s"} %f' % (metric, label, value, total))
+                lines.append('%s_count{%s="%s"} %d' % (metric, label, value, buckets[-1]))
+        for name, n in sorted(_counters.iteritems()):
+            lines.append('# TYPE klaus_%s_total counter' % name)
+            lines.append('klaus_%s_total %d' % (name, n))
+
+    for metric, kind, attribute in [
+        ('klaus_cache_hits_total', 'counter', 'hits'),
+        ('klaus_cache_misses_total', 'counter', 'misses'),
+        ('klaus_cache_evictions_total', 'counter', 'evictions'),
+        ('klaus_cache_size', 'gauge', 'size'),
+    ]:
+        lines.append('# TYPE %s %s' % (metric, kind))
+        for name, cache in sorted(caches.iteritems()):
+            lines.append('%s{cache="%s"} %d' % (metric, name, getattr(cache, attribute)))
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,111 @@
+"""
+The list of repositories klaus serves.
+
+It's read on first use rather than at import time, and the ``projects.list``
+file is re-read whenever it changes, so repositories can be added and removed
+without restarting the server.
+"""
+import os
+import time
+import logging
+import threading
+
+# how often (in seconds) to check whether `projects.list` has changed
+CHECK_INTERVAL = float(os.environ.get('KLAUS_PROJECTS_LIST_CHECK_INTERVAL', 5))
+
+
+class RepoRegistry(object):
+    """
+    Maps repository names to paths. The repositories are listed (relative to
+    `base_path`) one per line in the file `projects_list`, which is re-read
+    whenever it changes. While that file doesn't exist, they are taken from
+    the whitespace-separated string `repos` instead.
+
+    Listed paths that aren't directories are reported to `logger` whenever
+    the list is (re-)read.
+    """
+    def __init__(self, base_path='', suffix='', projects_list=None, repos='',
+                 logger=None):
+        self.base_path = base_path
+        self.suffix = suffix
+        self.projects_list = projects_list
+        self.repos = repos
+        self.logger = logger or logging.getLogger(__name__)
+        self._repos = None
+        self._version = None
+        self._checked = 0
+        self._lock = threading.Lock()
+
+    def _get(self):
+        now = time.time()
+        if self._repos is not None and now - self._checked < CHECK_INTERVAL:
+            return self._repos
+        with self._lock:
+            if self._repos is None or now - self._checked >= CHECK_INTERVAL:
+                self._checked = now
+                version = self._projects_list_version()
+                if self._repos is None or version != self._version:
+                    self._repos = self._load(version is not None)
+                    self._version = version
+        return self._repos
+
+    def _projects_list_version(self):
+        if self.projects_list is None:
+            return None
+        try:
+            st = os.stat(self.projects_list)
+        except OSError:
+            return None
+        # the inode changes when the file is replaced by renaming another
+        return st.st_mtime, st.st_size, st.st_ino
+
+    def _load(self, from_projects_list):
+        if not from_projects_list:
+            repos = dict((name.rstrip(os.sep), self.base_path + name)
+                         for name in self.repos.split())
+        else:
+            repos = {}
+            try:
+                with open(self.projects_list) as f:
+                    for line in f:
+                        line = line.strip()
+                        if line:
+                            repos[line.rstrip(os.sep)] = self.base_path + self.suffix + line
+            except IOError as exc:
+                self.logger.error('Could not read %s: %s', self.projects_list, exc)
+                # keep serving the repositories we know about
+                return self._repos or {}
+
+        missing = sorted(name for name, path in repos.iteritems()
+                         if not os.path.isdir(path))
+        if missing:
+            self.logger.warning('%d of %d repositories not found: %s%s',
+                                len(missing), len(repos), ', '.join(missing[:10]),
+                                ', ...' if len(missing) > 10 else '')
+        return repos
+
+    def __getitem__(self, name):
+        return self._get()[name]
+
+    def __contains__(self, name):
+        return name in self._get()
+
+    def __len__(self):
+        return len(self._get())
+
+    def __iter__(self):
+        return iter(self._get())
+
+    def iteritems(self):
+        return self._get().iteritems()
+
+
+def from_environ(logger=None):
+    """
+    Returns the registry configured by ``KLAUS_BASE_PATH``,
+    ``KLAUS_BASE_PATH_SUFFIX`` and either ``KLAUS_BASE_PATH/projects.list``,
+    if it exists, or ``KLAUS_REPOS``.
+    """
+    base_path = os.environ.get('KLAUS_BASE_PATH', '')
+    return RepoRegistry(base_path, os.environ.get('KLAUS_BASE_PATH_SUFFIX', ''),
+                        os.path.join(base_path, 'projects.list'), os.environ.get('KLAUS_REPOS', ''), logger)
@@ -1,77 +1,278 @@
 import os
-import itertools
-import cStringIO
+import stat
+import time
+import zlib
+import logging
+import threading
+import collections
 
-import dulwich, dulwich.patch
-from diff import prepare_udiff
+import dulwich, dulwich.repo, dulwich.refs, dulwich.objects, dulwich.object_store, dulwich.errors
+import workers
+from diff import DiffLine, diff_blobs
+from utils import guess_is_binary
+import metrics
+from cache import LRUCache
+from histindex import HistoryIndex
+from commitindex import CommitIndex, message_words
+from diffstat import DiffstatIndex
+from searchindex import SearchIndex
 
-def pairwise(iterable):
+# Caches shared by all repositories. Their keys start with the path of the
+# repository's object store, so no repository gets to see the objects of
+# another one: parsed tree objects by sha, `(mode, sha)` entries by
+# `(tree sha, path)` and `blob_info` tuples by blob sha.
+tree_cache = LRUCache(int(os.environ.get('KLAUS_TREE_CACHE_SIZE', 10000)),
+                      name='tree')
+tree_path_cache = LRUCache(int(os.environ.get('KLAUS_TREE_PATH_CACHE_SIZE', 100000)),
+                           name='tree_path')
+binary_cache = LRUCache(int(os.environ.get('KLAUS_BINARY_CACHE_SIZE', 100000)),
+                        name='binary')
+
+# Decompressed objects by object store path and hex sha as `(type_num, raw
+# string)` tuples, with a byte budget. Objects bigger than `OBJECT_CACHE_MAX_OBJECT_SIZE` (large blobs,
+# mostly) aren't cached so they can't wipe out the rest of the cache.
+object_cache = LRUCache(int(os.environ.get('KLAUS_OBJECT_CACHE_SIZE', 64*1024*1024)),
+                        sizeof=lambda raw: len(raw[1]), name='object')
+OBJECT_CACHE_MAX_OBJECT_SIZE = int(os.environ.get('KLAUS_OBJECT_CACHE_MAX_OBJECT_SIZE',
+                                                  1024*1024))
+# Objects resolved from pack files (delta bases, mostly) by pack file name and
+# offset, with a byte budget for all packs together. This replaces dulwich's
+# cache of 20 MB per pack.
+delta_base_cache = LRUCache(int(os.environ.get('KLAUS_DELTA_BASE_CACHE_SIZE', 32*1024*1024)),
+                            sizeof=lambda obj: sum(map(len, obj[1])),
+                            name='delta_base')
+
+class CachingObjectStore(dulwich.object_store.DiskObjectStore):
+    """
+    A `DiskObjectStore` that serves recently read objects from `object_cache`.
+
+    The pack directory isn't checked for new packs on every lookup; `RepoPool`
+    takes care of that and calls `RepoWrapper.reopen_object_store` instead.
     """
-    Yields the items in `iterable` pairwise:
+    def __init__(self, path):
+        super(CachingObjectStore, self).__init__(path)
+        # dulwich seeks around in shared pack file objects, so threads must
+        # take turns reading them
+        self._read_lock = threading.Lock()
+
+    def get_raw(self, name):
+        if len(name) == 20:
+            name = dulwich.objects.sha_to_hex(name)
+        key = (self.path, name)
+        raw = object_cache.get(key)
+        if raw is None:
+            with metrics.timer('objects'), self._read_lock:
+                raw = super(CachingObjectStore, self).get_raw(name)
+            metrics.count('objects_read')
+            metrics.count('bytes_inflated', len(raw[1]))
+            if len(raw[1]) <= OBJECT_CACHE_MAX_OBJECT_SIZE:
+                object_cache.set(key, raw)
+        return raw
+
+    def close(self):
+        """
+        Closes the open packs. If the store is used afterwards (by a request
+        that got its repository before the `RepoPool` evicted it), dulwich
+        opens them again.
+        """
+        with self._read_lock:
+            super(CachingObjectStore, self).close()
 
-    >>> list(pairwise(['a', 'b', 'c', 'd']))
-    [('a', 'b'), ('b', 'c'), ('c', 'd')]
+    def _pack_cache_stale(self):
+        return False
+
+    def _load_packs(self):
+        packs = super(CachingObjectStore, self)._load_packs()
+        for pack in packs:
+            pack._data_load = _pack_data_loader(pack._data_load)
+        return packs
+
+def _pack_data_loader(load):
+    def load_pack_data():
+        data = load()
+        data._offset_cache = DeltaBaseCache(data._filename)
+        return data
+    return load_pack_data
+
+class DeltaBaseCache(object):
+    """
+    Stands in for the offset cache of a dulwich `PackData`, keeping its
+    objects in `delta_base_cache`.
     """
-    prev = None
-    for item in iterable:
-        if prev is not None:
-            yield prev, item
-        prev = item
+    def __init__(self, filename):
+        self.filename = filename
+
+    def __contains__(self, offset):
+        return delta_base_cache.get((self.filename, offset)) is not None
+
+    def __getitem__(self, offset):
+        obj = delta_base_cache.get((self.filename, offset))
+        if obj is None:
+            raise KeyError(offset)
+        return obj
+
+    def __setitem__(self, offset, obj):
+        delta_base_cache.set((self.filename, offset), obj)
+
+# how long (in seconds) a ref snapshot is used without checking the refs
+REFS_CHECK_INTERVAL = float(os.environ.get('KLAUS_REFS_CHECK_INTERVAL', 1))
+
+class RefSnapshot(object):
+    """
+    The refs of a repository at some point in time (`refs` maps ref names to
+    shas) plus sorted lists of branch and tag names. Don't modify it.
+    """
+    def __init__(self, refs):
+        self.refs = refs
+        self.branches = sorted(ref[len('refs/heads/'):] for ref in refs
+                               if ref.startswith('refs/heads/'))
+        self.tags = sorted(ref[len('refs/tags/'):] for ref in refs
+                           if ref.startswith('refs/tags/'))
 
 class RepoWrapper(dulwich.repo.Repo):
+    def __init__(self, path):
+        dulwich.repo.Repo.__init__(self, path)
+        self.object_store = CachingObjectStore(self.object_store.path)
+
     def get_branch_or_commit(self, id):
         """
         Returns a `(commit_object, is_branch)` tuple for the commit or branch
         identified by `id`.
         """
+        refs = self.refs_snapshot().refs
+        if id in refs:
+            return self.peel(refs[id]), False
+        if 'refs/heads/' + id in refs:
+            return self[refs['refs/heads/' + id]], True
+        if 'refs/tags/' + id in refs:
+            return self.peel(refs['refs/tags/' + id]), False
+        if len(id) not in (20, 40):
+            raise KeyError(id)
         try:
-            return self[id], False
-        except KeyError:
-            return self.get_branch(id), True
+            return self.peel(id), False
+        except (TypeError, ValueError):
+            # not a (hex) sha
+            raise KeyError(id)
+
+    def peel(self, sha):
+        """
+        Returns the commit `sha` or the commit that the (annotated) tag `sha`
+        points to.
+        """
+        obj = self[sha]
+        while isinstance(obj, dulwich.objects.Tag):
+            obj = self[obj.object[1]]
+        if not isinstance(obj, dulwich.objects.Commit):
+            raise KeyError(sha)
+        return obj
 
     def get_branch(self, name):
         """ Returns the commit object pointed to by the branch `name`. """
-        return self['refs/heads/'+name]
+        return self[self.refs_snapshot().refs['refs/heads/'+name]]
 
     def get_default_branch(self):
         return self.get_branch('master')
 
     def get_branch_names(self, exclude=()):
         """ Returns a sorted list of branch names. """
-        branches = []
-        for ref in self.get_refs():
-            if ref.startswith('refs/heads/'):
-                name = ref[len('refs/heads/'):]
-                if name not in exclude:
-                    branches.append(name)
-        branches.sort()
-        return branches
+        return [name for name in self.refs_snapshot().branches
+                if name not in exclude]
 
     def get_tag_names(self):
         """ Returns a sorted list of tag names. """
-        tags = []
-        for ref in self.get_refs():
-            if ref.startswith('refs/tags/'):
-                tags.append(ref[len('refs/tags/'):])
-        tags.sort()
-        return tags
+        return list(self.refs_snapshot().tags)
 
-    def history(self, commit=None, path=None, max_commits=None, skip=0):
+    def refs_snapshot(self):
+        """
+        Returns a `RefSnapshot` of the repository's refs. The refs are only
+        read again if `refs_key` changed, which is checked at most every
+        `REFS_CHECK_INTERVAL` seconds.
+        """
+        now = time.time()
+        checked, key, snapshot = getattr(self, '_refs_snapshot', (None, None, None))
+        if checked is not None and now - checked < REFS_CHECK_INTERVAL:
+            return snapshot
+        new_key = refs_key(self.path)
+        if snapshot is None or new_key != key:
+            # dulwich never re-reads packed-refs by itself, so start over
+            # with a new refs container
+            self.refs = dulwich.refs.DiskRefsContainer(self.controldir())
+            snapshot = RefSnapshot(self.get_refs())
+        self._refs_snapshot = now, new_key, snapshot
+        return snapshot
+
+    @metrics.timed('history')
+    def history(self, commit=None, path=None, max_commits=None, skip=0,
+                after=None, order=None):
         """
         Returns a list of all commits that infected `path`, starting at branch
-        or commit `commit`. `skip` can be used for pagination, `max_commits`
-        to limit the number of commits returned.
+        or commit `commit`. `skip` or `after` (the sha of the last commit of
+        the previous page) can be used for pagination, `max_commits` to limit
+        the number of commits returned.
 
-        Similar to `git log [branch/commit] [--skip skip] [-n max_commits]`.
+        By default only the first-parent history is walked, similar to
+        `git log --first-parent [branch/commit] [--skip skip] [-n max_commits]`.
+        With an `order` of 'date' or 'topo', commits from merged branches are
+        included, too (see `CommitIndex.history`); `after` is ignored then.
         """
-        if not isinstance(commit, dulwich.objects.Commit):
+        if commit is None:
+            commit = self.get_default_branch()
+        elif not isinstance(commit, dulwich.objects.Commit):
             commit, _ = self.get_branch_or_commit(commit)
-        commits = self._history(commit)
-        path = path.strip('/')
+        path = (path or '').strip('/')
+        if order is not None:
+            shas = self.commit_index.history(self, commit, path, order,
+                                             max_commits, skip)
+        else:
+            shas = self.history_index.history(self, commit, path, max_commits,
+                                               skip, after)
+        return [self[sha] for sha in shas]
+
+    def diffstats(self, commits):
+        """
+        Returns the `Diffstat`s of `commits` by sha, leaving out those that
+        are still being computed (see `DiffstatIndex`).
+        """
+        return self.diffstat_index.get(self, commits)
+
+    @property
+    def diffstat_index(self):
+        return repo_index(self, DiffstatIndex)
+
+    @property
+    def search_index(self):
+        return repo_index(self, SearchIndex)
+
+    def is_ancestor(self, sha, commit):
+        """ Returns whether the commit `sha` is (an ancestor of) `commit`. """
+        return self.commit_index.is_ancestor(self, sha, commit)
+
+    @property
+    def history_index(self):
+        return repo_index(self, HistoryIndex)
+
+    @metrics.timed('history')
+    def search_commits(self, commit, path=None, author=None, since=None,
+                       until=None, text=None, max_commits=None, skip=0):
+        """
+        Returns `(sha, author, commit time, subject)` tuples of the commits
+        reachable from `commit` by `author` (a substring of the author's name
+        or address), committed in [`since`, `until`) and whose message
+        contains all words of `text`, newest first. With `path`, only commits
+        in `commit`'s first-parent history that changed `path` are returned.
+        Apart from indexing new commits, no commit objects are read.
+        """
+        shas = None
+        path = (path or '').strip('/')
         if path:
-            commits = (c1 for c1, c2 in pairwise(commits)
-                       if self._path_changed_between(path, c1, c2))
-        return list(itertools.islice(commits, skip, skip+max_commits))
+            shas = self.history_index.history(self, commit, path)
+        words = message_words(text.encode('utf-8')) if text else ()
+        return self.commit_index.search(self, commit, author, since, until,
+                                        words, shas, max_commits, skip)
+
+    @property
+    def commit_index(self):
+        return repo_index(self, CommitIndex)
 
     def _history(self, commit):
         """ Yields all commits that lead to `commit`. """
@@ -82,86 +283,453 @@ class RepoWrapper(dulwich.repo.Repo):
             commit = self[commit.parents[0]]
         yield commit
 
-    def _path_changed_between(self, path, commit1, commit2):
+    @metrics.timed('tree')
+    def get_tree(self, commit, path, noblobs=False):
+        """ Returns the Git tree object for `path` at `commit`. """
+        mode, sha = self.lookup_path(commit, path)
+        if stat.S_ISDIR(mode):
+            return self.get_tree_by_sha(sha)
+        return self[sha]
+
+    def get_tree_by_sha(self, sha):
+        """ Returns the tree object `sha`, using a cache shared by all repos. """
+        key = (self.object_store.path, sha)
+        tree = tree_cache.get(key)
+        if tree is None:
+            tree = self[sha]
+            # parse it now rather than in several threads at once later
+            len(tree)
+            tree_cache.set(key, tree)
+        return tree
+
+    def lookup_path(self, commit, path):
         """
-        Returns `True` if `path` changed between `commit1` and `commit2`,
-        including the case that the file was added or deleted in `commit2`.
+        Returns the `(mode, sha)` of the object at `path` in `commit` without
+        loading the object itself.
+        """
+        return self.lookup_tree_path(commit.tree, path)
+
+    @metrics.timed('tree')
+    def lookup_tree_path(self, tree, path):
+        """ Like `lookup_path`, but for the tree with the sha `tree`. """
+        path = '/'.join(name for name in path.split('/') if name)
+        if not path:
+            return stat.S_IFDIR, tree
+        key = (self.object_store.path, tree, path)
+        entry = tree_path_cache.get(key)
+        if entry is None:
+            directory, _, name = path.rpartition('/')
+            mode, sha = self.lookup_tree_path(tree, directory)
+            if not stat.S_ISDIR(mode):
+                raise KeyError(path)
+            entry = self.get_tree_by_sha(sha)[name]
+            tree_path_cache.set(key, entry)
+        return entry
+
+    def walk_tree(self, commit, path=''):
+        """
+        Yields the `(path, mode, sha)` of every file (and submodule) below
+        `path` in `commit`, depth first and in tree order.
+        """
+        for entry in self.get_tree(commit, path).iteritems():
+            entry_path = '/'.join(filter(None, [path, entry.path]))
+            if stat.S_ISDIR(entry.mode):
+                for item in self.walk_tree(commit, entry_path):
+                    yield item
+            else:
+                yield entry_path, entry.mode, entry.sha
+
+    def close(self):
+        """ Closes the repository's open packs. """
+        self.object_store.close()
+
+    def reopen_object_store(self):
+        """
+        Replaces the object store by a fresh one, e.g. after a repack. The old
+        one (and its open packs) is freed once no one uses it anymore.
+        """
+        self.object_store = self.object_store.__class__(self.object_store.path)
+
+    def is_binary(self, sha):
+        """ Returns whether the blob `sha` looks binary. """
+        return self.blob_info(sha)[1]
+
+    def blob_info(self, sha):
+        """
+        Returns the size of the blob `sha` and whether it looks binary. These
+        are cached, so the blob needn't be read (or, if it's packed,
+        decompressed) just to get them again.
+        """
+        key = (self.object_store.path, sha)
+        info = binary_cache.get(key)
+        if info is None:
+            size, chunks = self.open_blob(sha)
+            info = size, guess_is_binary(chunks)
+            if hasattr(chunks, 'close'):
+                chunks.close()
+            binary_cache.set(key, info)
+        return info
+
+    def open_blob(self, sha):
+        """
+        Returns a `(size, chunks)` tuple for the blob `sha`, where `chunks` is
+        an iterator over its contents. Loose objects and packed objects that
+        aren't deltified are decompressed while iterating, so they are never
+        held in memory as a whole.
         """
-        path, filename = os.path.split(path)
-        try:
-            blob1 = self.get_tree(commit1, path)
-            if not isinstance(blob1, dulwich.objects.Tree):
-                return True
-            blob1 = blob1[filename]
-        except KeyError:
-            blob1 = None
         try:
-            blob2 = self.get_tree(commit2, path)
-            if not isinstance(blob2, dulwich.objects.Tree):
-                return True
-            blob2 = blob2[filename]
-        except KeyError:
-            blob2 = None
-        if blob1 is None and blob2 is None:
-            # file present in neither tree
-            return False
-        return blob1 != blob2
+            f = open(self.object_store._get_shafile_path(sha), 'rb')
+        except IOError:
+            pass
+        else:
+            try:
+                type_name, size, chunks = read_loose_object(f)
+            except (ValueError, zlib.error):
+                # legacy loose object format, let dulwich handle it
+                f.close()
+            else:
+                if type_name != 'blob':
+                    f.close()
+                    raise KeyError(sha)
+                metrics.count('objects_read')
+                return size, chunks
+        blob = self._open_packed_blob(sha)
+        if blob is not None:
+            metrics.count('objects_read')
+            return blob
+        # deltified; dulwich has to put it together in memory
+        chunks = self[sha].chunked
+        return sum(map(len, chunks)), iter(chunks)
 
-    def get_tree(self, commit, path, noblobs=False):
-        """ Returns the Git tree object for `path` at `commit`. """
-        tree = self[commit.tree]
-        if path:
-            for directory in path.strip('/').split('/'):
-                if directory:
-                    tree = self[tree[directory][1]]
-        return tree
+    def _open_packed_blob(self, sha):
+        """
+        Returns `open_blob`'s `(size, chunks)` for the blob `sha` if it's
+        stored in a pack without being deltified, `None` otherwise.
+        """
+        object_store = self.object_store
+        with object_store._read_lock:
+            for pack in object_store.packs:
+                index = pack.index
+                object_offset = getattr(index, 'object_offset', None) or \
+                                index.object_index
+                try:
+                    offset = object_offset(sha)
+                except KeyError:
+                    continue
+                filename = pack.data._filename
+                break
+            else:
+                return None
+        # a file of our own, so the blob can be read while the response is
+        # sent without holding the lock
+        try:
+            f = open(filename, 'rb')
+        except IOError:
+            return None
+        try:
+            type_num, size, chunks = read_pack_object(f, offset)
+        except (ValueError, zlib.error):
+            f.close()
+            return None
+        if type_num in DELTA_TYPES:
+            f.close()
+            return None
+        if type_num != dulwich.objects.Blob.type_num:
+            f.close()
+            raise KeyError(sha)
+        return size, chunks
 
     def commit_diff(self, commit):
-        from klaus import guess_is_binary, force_unicode
+        """ Yields the diff of every file changed in `commit`. """
+        for change in self.commit_changes(commit):
+            yield self.file_diff(change)
 
+    def commit_changes(self, commit):
+        """
+        Yields a `((oldpath, newpath), (oldmode, newmode), (oldsha, newsha))`
+        tuple for every file changed in `commit`.
+        """
         if commit.parents:
             parent_tree = self[commit.parents[0]].tree
         else:
             parent_tree = None
+        return self.object_store.tree_changes(parent_tree, commit.tree)
 
-        changes = self.object_store.tree_changes(parent_tree, commit.tree)
-        for (oldpath, newpath), (oldmode, newmode), (oldsha, newsha) in changes:
-            try:
-                if newsha and guess_is_binary(self[newsha].chunked) or \
-                   oldsha and guess_is_binary(self[oldsha].chunked):
-                    yield {
-                        'is_binary': True,
-                        'old_filename': oldpath or '/dev/null',
-                        'new_filename': newpath or '/dev/null',
-                        'chunks': [[{'line' : 'Binary diff not shown'}]]
-                    }
-                    continue
-            except KeyError:
-                # newsha/oldsha are probably related to submodules.
-                # Dulwich will handle that.
-                pass
-
-            stringio = cStringIO.StringIO()
-            dulwich.patch.write_object_diff(stringio, self.object_store,
-                                            (oldpath, oldmode, oldsha),
-                                            (newpath, newmode, newsha))
-            files = prepare_udiff(force_unicode(stringio.getvalue()),
-                                  want_header=False)
-            if not files:
-                # the diff module doesn't handle deletions/additions
-                # of empty files correctly.
-                yield {
-                    'old_filename': oldpath or '/dev/null',
-                    'new_filename': newpath or '/dev/null',
-                    'chunks': []
-                }
+    @metrics.timed('diff')
+    def file_diff(self, change, max_lines=None):
+        """
+        Returns the diff for a change yielded by `commit_changes`. Its
+        'chunks' are `None` if it would have more than `max_lines` lines.
+        """
+        (oldpath, newpath), (oldmode, newmode), (oldsha, newsha) = change
+        file = {
+            'old_filename': oldpath or '/dev/null',
+            'new_filename': newpath or '/dev/null',
+        }
+        for mode, sha in [(oldmode, oldsha), (newmode, newsha)]:
+            if sha is not None and not dulwich.objects.S_ISGITLINK(mode) \
+               and self.is_binary(sha):
+                file['is_binary'] = True
+                file['chunks'] = [[DiffLine(u'', u'', u'', u'Binary diff not shown')]]
+                return file
+        old = self._diff_data(oldmode, oldsha)
+        new = self._diff_data(newmode, newsha)
+        file['chunks'] = workers.pool.run(
+            diff_blobs, (old, new, max_lines), lambda: [[
+                DiffLine(u'', u'', u'', u'Diff not shown (took too long to compute)')
+            ]])
+        return file
+
+    def _diff_data(self, mode, sha):
+        if sha is None:
+            return ''
+        if dulwich.objects.S_ISGITLINK(mode):
+            # submodule; the commit isn't part of this repository
+            return 'Subproject commit %s\n' % sha
+        return self[sha].data
+
+
+# Per-repository indexes by class and repository path. They are kept apart
+# from the `RepoPool`, so closing and reopening a repository doesn't throw
+# them away. They don't keep a reference to the repository (which would keep
+# its packs open after the pool closed it); it's passed to their methods.
+_repo_indexes = {}
+_repo_indexes_lock = threading.Lock()
+
+def repo_index(repo, cls):
+    """ Returns the `cls` index (e.g. a `CommitIndex`) of `repo`. """
+    key = (cls, repo.path)
+    index = _repo_indexes.get(key)
+    if index is None:
+        with _repo_indexes_lock:
+            index = _repo_indexes.get(key)
+            if index is None:
+                index = _repo_indexes[key] = cls(repo.path)
+    return index
+
+
+def read_loose_object(f, chunk_size=64*1024):
+    """
+    Returns a `(type_name, size, chunks)` tuple for the loose object file `f`.
+    `chunks` yields the decompressed contents in pieces of at most
+    `chunk_size` bytes and closes `f` when done.
+    """
+    decompressor = zlib.decompressobj()
+    data = ''
+    while '\0' not in data:
+        raw = decompressor.unconsumed_tail or f.read(chunk_size)
+        if not raw:
+            raise ValueError("Invalid loose object header")
+        data += decompressor.decompress(raw, chunk_size)
+    header, data = data.split('\0', 1)
+    try:
+        type_name, size = header.split(' ', 1)
+        size = int(size)
+    except ValueError:
+        raise ValueError("Invalid loose object header %r" % header[:32])
+    return type_name, size, _inflate(f, decompressor, data, chunk_size)
+
+# pack object types whose data is a delta against another object
+DELTA_TYPES = (6, 7)
+
+def read_pack_object(f, offset, chunk_size=64*1024):
+    """
+    Returns a `(type_num, size, chunks)` tuple for the object at `offset` in
+    the pack file `f`. `chunks` yields its decompressed contents like
+    `read_loose_object`'s, or is `None` if it's a delta (see `DELTA_TYPES`).
+    """
+    f.seek(offset)
+    raw = f.read(chunk_size)
+    if not raw:
+        raise ValueError("Invalid pack object offset %d" % offset)
+    # type and size, the latter in little-endian groups of 7 bits
+    byte = ord(raw[0])
+    type_num = (byte >> 4) & 7
+    size = byte & 0x0f
+    shift, i = 4, 1
+    while byte & 0x80:
+        if i == len(raw):
+            raise ValueError("Invalid pack object header")
+        byte = ord(raw[i])
+        size |= (byte & 0x7f) << shift
+        shift += 7
+        i += 1
+    if type_num in DELTA_TYPES:
+        return type_num, size, None
+    decompressor = zlib.decompressobj()
+    data = decompressor.decompress(raw[i:], chunk_size)
+    return type_num, size, _inflate(f, decompressor, data, chunk_size)
+
+def _inflate(f, decompressor, data, chunk_size):
+    """
+    Yields `data` and whatever else `decompressor` inflates from the rest of
+    `f` until the end of the compressed stream, then closes `f`.
+    """
+    try:
+        if data:
+            yield data
+        # `unused_data` is what follows the end of the stream (e.g. the next
+        # object of a pack)
+        while not decompressor.unused_data:
+            raw = decompressor.unconsumed_tail or f.read(chunk_size)
+            if not raw:
+                break
+            chunk = decompressor.decompress(raw, chunk_size)
+            if chunk:
+                yield chunk
+    finally:
+        f.close()
+
+
+class RepoPool(object):
+    """
+    Keeps up to `max_repos` repositories open, closing the object stores of
+    the least recently used ones if that or `max_packs` (the total number of
+    pack files the open repositories may hold open) is exceeded.
+
+    When a repository is handed out again, its pack directory is checked
+    for changes (e.g. by ``git gc``) with a single `stat`. If it changed,
+    its object store is replaced, so no stale or deleted packs are used.
+    Refs are read from disk by dulwich anyway.
+    """
+    def __init__(self, max_repos, max_packs):
+        self.max_repos = max_repos
+        self.max_packs = max_packs
+        self.open_packs = 0
+        # path -> [repo, pack directory mtime, number of packs]
+        self._repos = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._repos)
+
+    def get(self, name, path):
+        with self._lock:
+            entry = self._repos.pop(path, None)
+            if entry is None:
+                repo = RepoWrapper(path)
+                repo.name = name
+                entry = [repo, None, 0]
             else:
-                yield files[0]
+                repo = entry[0]
+                self.open_packs -= entry[2]
+            pack_dir = repo.object_store.pack_dir
+            mtime = _mtime(pack_dir)
+            if mtime != entry[1]:
+                if entry[1] is not None:
+                    repo.reopen_object_store()
+                entry[1] = mtime
+                entry[2] = _count_packs(pack_dir)
+            self._repos[path] = entry
+            self.open_packs += entry[2]
+
+            evicted = []
+            while len(self._repos) > 1 and (len(self._repos) > self.max_repos or
+                                            self.open_packs > self.max_packs):
+                _, (evicted_repo, _, packs) = self._repos.popitem(last=False)
+                self.open_packs -= packs
+                evicted.append(evicted_repo)
+        # outside the lock, since closing waits for reads of the packs
+        for evicted_repo in evicted:
+            evicted_repo.object_store.close()
+        return repo
+
+def _mtime(path):
+    try:
+        return os.stat(path).st_mtime
+    except OSError:
+        return None
+
+def _count_packs(pack_dir):
+    try:
+        return sum(1 for name in os.listdir(pack_dir) if name.endswith('.pack'))
+    except OSError:
+        return 0
+
+pool = RepoPool(
+    max_repos=int(os.environ.get('KLAUS_MAX_OPEN_REPOS', 100)),
+    max_packs=int(os.environ.get('KLAUS_MAX_OPEN_PACKS', 1000)),
+)
 
+def Repo(name, path):
+    return pool.get(name, path)
 
-def Repo(name, path, _cache={}):
-    repo = _cache.get(path)
-    if repo is None:
-        repo = _cache[path] = RepoWrapper(path)
-        repo.name = name
-    return repo
+
+# how long (in seconds) a summary is used without checking the repo's refs
+SUMMARY_CHECK_INTERVAL = float(os.environ.get('KLAUS_SUMMARY_CHECK_INTERVAL', 5))
+
+# `(time checked, refs key, summary)` by repository path
+_summaries = {}
+
+RepoSummary = collections.namedtuple('RepoSummary',
+                                     'name last_updated head branch_count')
+
+def refs_key(path):
+    """
+    Returns a value that changes whenever the refs of the repository at `path`
+    change: the mtimes of ``HEAD``, ``packed-refs`` and all directories below
+    ``refs/`` (git updates loose refs by renaming a lock file into place).
+    """
+    controldir = os.path.join(path, '.git')
+    if not os.path.isdir(controldir):
+        controldir = path
+    key = []
+    for name in ['HEAD', 'packed-refs']:
+        try:
+            key.append(os.stat(os.path.join(controldir, name)).st_mtime)
+        except OSError:
+            key.append(None)
+    for dirpath, dirnames, filenames in os.walk(os.path.join(controldir, 'refs')):
+        key.append((dirpath, os.stat(dirpath).st_mtime))
+    return key
+
+def repo_summaries(repos, logger=None):
+    """
+    Returns the `RepoSummary`s of the repositories `repos` (an iterable of
+    `(name, path)` tuples) that exist. Each repository's `refs_key` (a few
+    `stat` calls) is checked at most every `SUMMARY_CHECK_INTERVAL` seconds;
+    only repositories whose refs changed are read again.
+    """
+    now = time.time()
+    summaries = []
+    for name, path in repos:
+        checked, _, summary = _summaries.get(path, (None, None, None))
+        if checked is None or now - checked >= SUMMARY_CHECK_INTERVAL:
+            summary = repo_summary(name, path, logger)
+        if summary is not None:
+            summaries.append(summary)
+    return summaries
+
+def repo_summary(name, path, logger=None):
+    """
+    Returns a `RepoSummary` for the repository at `path`, or `None` (which is
+    reported to `logger`) if there is no repository. It is only recomputed if
+    the repository's refs changed since the last call.
+    """
+    now = time.time()
+    checked, key, summary = _summaries.get(path, (None, None, None))
+    new_key = refs_key(path)
+    if checked is None or new_key != key:
+        # not from the pool, where it would push out the repositories that
+        # are actually being browsed
+        try:
+            repo = RepoWrapper(path)
+        except dulwich.errors.NotGitRepository:
+            (logger or logging.getLogger(__name__)).warning(
+                'Repository %s not found at %s', name, path)
+            _summaries[path] = (now, new_key, None)
+            return None
+        try:
+            snapshot = repo.refs_snapshot()
+            commit_times = [getattr(repo[sha], 'commit_time', None)
+                            for sha in set(snapshot.refs.itervalues())]
+        finally:
+            repo.close()
+        summary = RepoSummary(
+            name=name,
+            last_updated=max(commit_times) if commit_times else None,
+            head=snapshot.refs.get('HEAD'),
+            branch_count=len(snapshot.branches)
+        )
+    _summaries[path] = (now, new_key, summary)
+    return summary
@@ -0,0 +1,669 @@
+"""
+Trigram index for searching the files of a commit.
+
+For every blob, the trigrams of its words (runs of ``\\w`` characters,
+lowercased) are computed once and kept on disk, so they are shared by all
+commits and refs containing the blob. The index of a tree maps each trigram to
+the files containing it. Indexes are written as segments to the repository's
+cache directory (or to anonymous temporary files if caching is disabled) and
+read with `mmap`, so they needn't fit into memory and survive restarts.
+
+Indexes are built in the background, by one thread for all repositories. A
+tree without a segment of its own starts out as the segment closest to it in
+time, with the files that changed in between hidden and their new versions
+added to a small index in memory. Once that holds `SEGMENT_MIN_CHANGES` files,
+the tree gets a segment of its own. Until an index is complete, searches are
+answered from the files indexed so far and say so.
+
+A query is a regular expression. The literal strings every match must contain
+are taken from it, the trigrams of their words select the candidate files, and
+only those are searched with the regular expression.
+"""
+import os
+import re
+import mmap
+import time
+import array
+import heapq
+import struct
+import marshal
+import tempfile
+import threading
+import itertools
+import collections
+import sre_parse
+import sre_constants
+
+import dulwich.objects
+
+import metrics
+import workers
+from cache import LRUCache, DiskCache, cache_dir, repo_cache_dir
+
+WORD_RE = re.compile(r'\w+')
+
+# bigger blobs (and binary ones) aren't indexed or searched
+MAX_FILE_SIZE = int(os.environ.get('KLAUS_SEARCH_MAX_FILE_SIZE', 1024*1024))
+# results are cut off after this many matching files (or candidates searched)
+MAX_FILES = int(os.environ.get('KLAUS_SEARCH_MAX_FILES', 100))
+MAX_CANDIDATES = int(os.environ.get('KLAUS_SEARCH_MAX_CANDIDATES', 10000))
+MAX_LINES_PER_FILE = 10
+
+# number of changed files kept in memory on top of a segment before the tree
+# gets a segment of its own
+SEGMENT_MIN_CHANGES = int(os.environ.get('KLAUS_SEARCH_SEGMENT_MIN_CHANGES', 1000))
+# segments kept per repository; the least recently used ones are removed
+SEGMENTS_PER_REPO = int(os.environ.get('KLAUS_SEARCH_SEGMENTS_PER_REPO', 4))
+
+# share of the time the background thread may spend indexing
+BACKGROUND_LOAD = float(os.environ.get('KLAUS_SEARCH_BACKGROUND_LOAD', 0.5))
+# set to index in the request instead, e.g. while benchmarking
+BACKGROUND_DISABLED = bool(os.environ.get('KLAUS_NO_BACKGROUND_INDEXING'))
+
+# the trigrams of every blob, concatenated, by blob sha ('-' for blobs that
+# aren't searched)
+trigram_cache = DiskCache(cache_dir('trigrams'))
+
+# complete `TreeIndex`es by repository path and tree sha, measured by the
+# number of postings they hold in memory
+index_cache = LRUCache(
+    int(os.environ.get('KLAUS_SEARCH_INDEX_SIZE', 5*1000*1000)),
+    sizeof=lambda index: index.size, name='search_index'
+)
+# `TreeIndex`es that are being built, by the same keys. `_index_lock` guards
+# both, so every index is only built once.
+_building = {}
+_index_lock = threading.Lock()
+
+# indexes to build as `(key, index, SearchIndex, repository class, repository
+# path, commit)` tuples, and the thread doing it. It opens the repositories itself,
+# so they needn't stay in the `RepoPool`.
+_queue = collections.deque()
+_queue_lock = threading.Lock()
+_thread = None
+
+# set when the process exits
+_stop = threading.Event()
+
+# file ids in segments
+ID_TYPE = 'I'
+SEGMENT_VERSION = 1
+
+
+def trigrams(data):
+    """ Returns the set of trigrams of the (lowercased) words in `data`. """
+    result = set()
+    for word in set(WORD_RE.findall(data.lower())):
+        for i in xrange(len(word) - 2):
+            result.add(word[i:i+3])
+    return result
+
+
+def blob_trigrams(repo, sha):
+    """
+    Returns the trigrams of the blob `sha` or `None` if it's too big or
+    binary to be searched.
+    """
+    string = trigram_cache.get(sha)
+    if string is not None:
+        if string == '-':
+            return None
+        return set(string[i:i+3] for i in xrange(0, len(string), 3))
+
+    size, is_binary = repo.blob_info(sha)
+    if size > MAX_FILE_SIZE or is_binary:
+        result = None
+        trigram_cache.set(sha, '-')
+    else:
+        result = trigrams(''.join(repo.open_blob(sha)[1]))
+        trigram_cache.set(sha, ''.join(result))
+    metrics.count('search_blobs_indexed')
+    return result
+
+
+def _intersect(postings, count):
+    """
+    Returns the ascending ids in all of `postings` (ascending sequences of
+    file ids) or, if there are none, all ids below `count`.
+    """
+    if not postings:
+        return xrange(count)
+    postings = sorted(postings, key=len)
+    ids = set(postings[0])
+    for other in postings[1:]:
+        if not ids:
+            break
+        ids.intersection_update(other)
+    return sorted(ids)
+
+
+class Postings(object):
+    """
+    Inverted trigram index of files in memory. `files` lists the files'
+    `(path, sha)`, their ids being their positions, and `postings` maps every
+    trigram to an array of the ids of the files containing it, ascending.
+    """
+    def __init__(self):
+        self.files = []
+        self.postings = {}
+        self.size = 0
+
+    def add(self, path, sha, file_trigrams):
+        id = len(self.files)
+        self.files.append((path, sha))
+        postings = self.postings
+        for trigram in file_trigrams:
+            ids = postings.get(trigram)
+            if ids is None:
+                ids = postings[trigram] = array.array(ID_TYPE)
+            ids.append(id)
+        self.size += len(file_trigrams)
+
+
+class Segment(object):
+    """
+    The index of a tree in a file, read with `mmap`. Files are sorted by path,
+    so ids are in path order.
+
+    The file holds the files' entries (``sha path``), their offsets (one more
+    than there are files), the arrays of file ids per trigram, the marshalled
+    directory of those arrays and finally the directory's offset and length.
+    Offsets and lengths take 8 bytes each.
+    """
+    def __init__(self, f, tree, commit_time):
+        self.tree, self.commit_time = tree, commit_time
+        self.buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            offset, length = struct.unpack('<QQ', self.buffer[-16:])
+            version, id_size, self.file_count, self._offsets, self._postings = \
+                marshal.loads(self.buffer[offset:offset+length])
+        except (struct.error, ValueError, EOFError, TypeError):
+            raise ValueError("Invalid search index segment")
+        if version != SEGMENT_VERSION or id_size != array.array(ID_TYPE).itemsize:
+            raise ValueError("Incompatible search index segment")
+
+    def file(self, id):
+        """ Returns the `(path, sha)` of the file `id`. """
+        start, stop = struct.unpack_from('<QQ', self.buffer, self._offsets + 8*id)
+        entry = self.buffer[start:stop]
+        return entry[41:], entry[:40]
+
+    def find(self, path):
+        """ Returns the id of the file `path` or `None`. """
+        lo, hi = 0, self.file_count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.file(mid)[0] < path:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < self.file_count and self.file(lo)[0] == path:
+            return lo
+        return None
+
+    def posting(self, trigram):
+        """ Returns the array of the ids of the files containing `trigram`. """
+        ids = array.array(ID_TYPE)
+        entry = self._postings.get(trigram)
+        if entry is not None:
+            offset, count = entry
+            ids.fromstring(self.buffer[offset:offset + count*ids.itemsize])
+        return ids
+
+    def trigrams(self):
+        return self._postings.keys()
+
+
+def write_segment(f, files, postings):
+    """
+    Writes a `Segment` of `files` (`(path, sha)` tuples sorted by path) and
+    `postings` (`(trigram, ascending file ids)` tuples) to `f`.
+    """
+    offsets = []
+    for path, sha in files:
+        offsets.append(f.tell())
+        f.write(sha + ' ' + path)
+    offsets.append(f.tell())
+    offsets_offset = f.tell()
+    f.write(struct.pack('<%dQ' % len(offsets), *offsets))
+    directory = {}
+    for trigram, ids in postings:
+        if not isinstance(ids, array.array):
+            ids = array.array(ID_TYPE, ids)
+        directory[trigram] = f.tell(), len(ids)
+        f.write(ids.tostring())
+    offset = f.tell()
+    data = marshal.dumps((SEGMENT_VERSION, array.array(ID_TYPE).itemsize,
+                          len(files), offsets_offset, directory))
+    f.write(data)
+    f.write(struct.pack('<QQ', offset, len(data)))
+
+
+def merge(base, hidden, delta):
+    """
+    Returns the files and postings (see `write_segment`) of the files of the
+    segment `base` (if any) but those with ids in `hidden`, plus those of the
+    `Postings` `delta`.
+    """
+    entries = []
+    if base is not None:
+        for id in xrange(base.file_count):
+            if id not in hidden:
+                entries.append(base.file(id) + (0, id))
+    entries.extend((path, sha, 1, id) for id, (path, sha) in enumerate(delta.files))
+    entries.sort()
+    # new ids of the base's and the delta's files (-1 for hidden ones)
+    new_ids = (array.array('l', [-1]) * (base.file_count if base else 0),
+               array.array('l', [-1]) * len(delta.files))
+    for new_id, (_, _, source, id) in enumerate(entries):
+        new_ids[source][id] = new_id
+    all_trigrams = set(delta.postings)
+    if base is not None:
+        all_trigrams.update(base.trigrams())
+
+    def postings():
+        for trigram in sorted(all_trigrams):
+            ids = []
+            if base is not None:
+                base_ids = new_ids[0]
+                ids = [base_ids[id] for id in base.posting(trigram)]
+                ids = [id for id in ids if id >= 0]
+            delta_ids = new_ids[1]
+            ids.extend(delta_ids[id] for id in delta.postings.get(trigram, ()))
+            ids.sort()
+            yield trigram, ids
+    return [(path, sha) for path, sha, _, _ in entries], postings()
+
+
+class TreeIndex(object):
+    """
+    The index of a tree: the files of the `Segment` `base` (if any) except
+    those with ids in `hidden`, plus the files in `delta`. Until the index is
+    `complete`, `done` of the `total` files to add to `delta` have been
+    added.
+    """
+    def __init__(self, tree, base=None):
+        self.tree = tree
+        self.base = base
+        self.hidden = set()
+        self.delta = Postings()
+        self.done = self.total = 0
+        self.complete = False
+        self.lock = threading.Lock()
+
+    @property
+    def size(self):
+        return self.delta.size + len(self.hidden) + 1
+
+    def candidates(self, query_trigrams, limit):
+        """
+        Returns the `(path, sha)` of the first `limit` files (by path) that
+        contain all of `query_trigrams` (of all files, if there are none), and
+        whether there are more.
+        """
+        with self.lock:
+            delta = self.delta
+            ids = _intersect([delta.postings.get(trigram, ()) for trigram in query_trigrams],
+                             len(delta.files))
+            delta_files = sorted(delta.files[id] for id in ids)
+            base_files = []
+            if self.base is not None:
+                base = self.base
+                ids = _intersect([base.posting(trigram) for trigram in query_trigrams],
+                                 base.file_count)
+                for id in ids:
+                    if id not in self.hidden:
+                        base_files.append(base.file(id))
+                        if len(base_files) > limit:
+                            break
+        files = list(itertools.islice(heapq.merge(base_files, delta_files), limit + 1))
+        return files[:limit], len(files) > limit
+
+
+class SearchIndex(object):
+    """
+    The `Segment`s of a repository's trees. On disk, they're named after the
+    time of the commit they were built for and their tree.
+    """
+    def __init__(self, path):
+        self.path = path
+        directory = repo_cache_dir(path)
+        if directory is not None:
+            directory = os.path.join(directory, 'search')
+            try:
+                os.mkdir(directory)
+            except OSError:
+                if not os.path.isdir(directory):
+                    directory = None
+        self.directory = directory
+        self.lock = threading.Lock()
+        # opened segments by tree, least recently used first
+        self.segments = collections.OrderedDict()
+
+    def get(self, tree):
+        """ Returns the segment of `tree` or `None`. """
+        for name_tree, commit_time in self._list():
+            if name_tree == tree:
+                return self._open(tree, commit_time)
+        return None
+
+    def nearest(self, commit_time):
+        """ Returns the segment closest in time to `commit_time` or `None`. """
+        segments = self._list()
+        while segments:
+            tree, segment_time = min(segments, key=lambda segment:
+                                     abs(segment[1] - commit_time))
+            segment = self._open(tree, segment_time)
+            if segment is not None:
+                return segment
+            segments.remove((tree, segment_time))
+        return None
+
+    def add(self, tree, commit_time, files, postings):
+        """ Writes and returns the segment of `tree`. """
+        if self.directory is None:
+            f = tempfile.TemporaryFile()
+        else:
+            fd, tmp = tempfile.mkstemp(dir=self.directory, prefix='.tmp')
+            f = os.fdopen(fd, 'w+b')
+        with f:
+            try:
+                write_segment(f, files, postings)
+                f.flush()
+                segment = Segment(f, tree, commit_time)
+                if self.directory is not None:
+                    os.rename(tmp, os.path.join(self.directory,
+                                                '%d-%s' % (commit_time, tree)))
+            finally:
+                if self.directory is not None and os.path.exists(tmp):
+                    os.unlink(tmp)
+        with self.lock:
+            self.segments[tree] = segment
+            while len(self.segments) > SEGMENTS_PER_REPO:
+                self.segments.popitem(last=False)
+        self._remove_old()
+        return segment
+
+    def _list(self):
+        """ Returns the `(tree, commit time)` of the segments there are. """
+        if self.directory is None:
+            with self.lock:
+                return [(tree, segment.commit_time)
+                        for tree, segment in self.segments.iteritems()]
+        segments = []
+        try:
+            names = os.listdir(self.directory)
+        except OSError:
+            return []
+        for name in names:
+            commit_time, _, tree = name.partition('-')
+            if len(tree) == 40:
+                segments.append((tree, int(commit_time)))
+        return segments
+
+    def _open(self, tree, commit_time):
+        with self.lock:
+            segment = self.segments.pop(tree, None)
+            if segment is not None:
+                self.segments[tree] = segment
+                return segment
+        if self.directory is None:
+            return None
+        path = os.path.join(self.directory, '%d-%s' % (commit_time, tree))
+        try:
+            with open(path, 'rb') as f:
+                segment = Segment(f, tree, commit_time)
+            # the modification time doubles as the time of last use
+            os.utime(path, None)
+        except (IOError, OSError, ValueError):
+            return None
+        with self.lock:
+            self.segments[tree] = segment
+            while len(self.segments) > SEGMENTS_PER_REPO:
+                self.segments.popitem(last=False)
+        return segment
+
+    def _remove_old(self):
+        """ Removes the least recently used segments from disk. """
+        if self.directory is None:
+            return
+        files = []
+        for tree, commit_time in self._list():
+            path = os.path.join(self.directory, '%d-%s' % (commit_time, tree))
+            try:
+                files.append((os.stat(path).st_mtime, path))
+            except OSError:
+                pass
+        files.sort()
+        for _, path in files[:-SEGMENTS_PER_REPO]:
+            try:
+                # processes that opened it can go on using it
+                os.unlink(path)
+            except OSError:
+                pass
+
+
+def get_index(repo, commit):
+    """
+    Returns the `TreeIndex` of `commit`'s tree, which is built (in the
+    background, unless that's disabled) if necessary.
+    """
+    key = (repo.path, commit.tree)
+    with _index_lock:
+        index = _building.get(key) or index_cache.get(key)
+    if index is not None:
+        return index
+
+    search_index = repo.search_index
+    segment = search_index.get(commit.tree)
+    if segment is not None:
+        index = TreeIndex(commit.tree, segment)
+        index.complete = True
+        index_cache.set(key, index)
+        return index
+
+    base = search_index.nearest(commit.commit_time)
+    with _index_lock:
+        index = _building.get(key)
+        if index is not None:
+            return index
+        index = _building[key] = TreeIndex(commit.tree, base)
+    job = key, index, search_index, repo.__class__, repo.path, commit
+    if BACKGROUND_DISABLED:
+        _build(*job)
+    else:
+        _enqueue(job)
+    return index
+
+
+def _build(key, index, search_index, repo_class, path, commit):
+    """
+    Adds the files of `commit` that aren't in `index.base` to `index` and
+    writes it as a segment of `search_index` if it's big enough.
+    """
+    try:
+        if _index(index, repo_class, path, commit):
+            if index.base is None or len(index.delta.files) >= SEGMENT_MIN_CHANGES:
+                try:
+                    segment = search_index.add(commit.tree, commit.commit_time,
+                                               *merge(index.base, index.hidden, index.delta))
+                except (IOError, OSError):
+                    # keep using it from memory
+                    pass
+                else:
+                    with index.lock:
+                        index.base, index.hidden, index.delta = segment, set(), Postings()
+            index.complete = True
+    finally:
+        with _index_lock:
+            _building.pop(key, None)
+            if index.complete:
+                index_cache.set(key, index)
+
+
+def _index(index, repo_class, path, commit):
+    """
+    Adds the files of `commit` that aren't in `index.base` to `index`.
+    Returns whether all of them were added.
+    """
+    repo = repo_class(path)
+    try:
+        pending = []
+        if index.base is None:
+            pending = [(file_path, sha) for file_path, mode, sha in repo.walk_tree(commit)
+                       if not dulwich.objects.S_ISGITLINK(mode)]
+        else:
+            hidden = set()
+            for (oldpath, newpath), (oldmode, newmode), (oldsha, newsha) in \
+                    repo.object_store.tree_changes(index.base.tree, commit.tree):
+                if oldpath is not None:
+                    id = index.base.find(oldpath)
+                    if id is not None:
+                        hidden.add(id)
+                if newpath is not None and not dulwich.objects.S_ISGITLINK(newmode):
+                    pending.append((newpath, newsha))
+            with index.lock:
+                index.hidden = hidden
+        index.total = len(pending)
+
+        start = time.time()
+        for i, (file_path, sha) in enumerate(pending):
+            if _stop.is_set():
+                return False
+            file_trigrams = blob_trigrams(repo, sha)
+            with index.lock:
+                if file_trigrams is not None:
+                    index.delta.add(file_path, sha, file_trigrams)
+                index.done += 1
+            if i % 100 == 99 and not BACKGROUND_DISABLED:
+                # pause to keep to `BACKGROUND_LOAD`, or until exiting
+                _stop.wait((time.time() - start) * (1 / BACKGROUND_LOAD - 1))
+                start = time.time()
+        return True
+    finally:
+        repo.close()
+
+
+def _enqueue(job):
+    global _thread
+    with _queue_lock:
+        if _stop.is_set():
+            return
+        _queue.append(job)
+        if _thread is None:
+            _thread = threading.Thread(target=_run, name='search-index')
+            _thread.daemon = True
+            _thread.start()
+
+def _run():
+    global _thread
+    try:
+        while True:
+            with _queue_lock:
+                if not _queue or _stop.is_set():
+                    # under the lock, so `_enqueue` starts a new thread for
+                    # anything it queues from now on
+                    _thread = None
+                    # not built; they're queued again when searched
+                    for job in _queue:
+                        with _index_lock:
+                            _building.pop(job[0], None)
+                    _queue.clear()
+                    return
+                job = _queue.popleft()
+            _build(*job)
+    except Exception:
+        with _queue_lock:
+            _thread = None
+        raise
+
+
+@workers.on_exit
+def _stop_threads():
+    _stop.set()
+    thread = _thread
+    if thread is not None:
+        thread.join(5)
+
+
+def required_literals(pattern):
+    """
+    Returns strings every match of the parsed regular expression `pattern`
+    must contain.
+    """
+    literals = []
+    current = []
+    def flush():
+        if current:
+            literals.append(''.join(current))
+            del current[:]
+    for op, value in pattern:
+        if op == sre_constants.LITERAL:
+            current.append(chr(value))
+            continue
+        flush()
+        if op == sre_constants.SUBPATTERN:
+            literals.extend(required_literals(value[1]))
+        elif op in (sre_constants.MAX_REPEAT, sre_constants.MIN_REPEAT) and value[0] >= 1:
+            literals.extend(required_literals(value[2]))
+    flush()
+    return literals
+
+
+def compile_query(query):
+    """
+    Returns the compiled regular expression of `query` (a byte string) and the
+    trigrams every matching file contains. Invalid regular expressions are
+    searched for literally.
+    """
+    try:
+        regex = re.compile(query, re.MULTILINE)
+    except (re.error, OverflowError):
+        query = re.escape(query)
+        regex = re.compile(query, re.MULTILINE)
+    query_trigrams = set()
+    for literal in required_literals(sre_parse.parse(query)):
+        query_trigrams.update(trigrams(literal))
+    return regex, query_trigrams
+
+
+@metrics.timed('search')
+def search(repo, commit, query):
+    """
+    Searches the files of `commit` for the regular expression `query` (a byte
+    string). Returns a dict with the list of `files` matched, each a dict with
+    its `path` and `lines` (a list of `(line number, line)`), whether the
+    results are `truncated` and, while the index is still being built, how
+    many of how many files to index were `indexed` so far (else `None`).
+    """
+    regex, query_trigrams = compile_query(query)
+    index = get_index(repo, commit)
+    indexed = None if index.complete else (index.done, index.total)
+    candidates, truncated = index.candidates(query_trigrams, MAX_CANDIDATES)
+    metrics.count('search_candidates', len(candidates))
+
+    files = []
+    for path, sha in candidates:
+        data = ''.join(repo.open_blob(sha)[1])
+        lines = []
+        # start and number of the line of the previous match
+        start, number = 0, 1
+        for match in regex.finditer(data):
+            if len(lines) == MAX_LINES_PER_FILE:
+                break
+            if lines and match.start() <= end:
+                # same line as the previous match
+                continue
+            line_start = data.rfind('\n', start, match.start()) + 1 or start
+            number += data.count('\n', start, line_start)
+            start = line_start
+            end = data.find('\n', match.start())
+            if end == -1:
+                end = len(data)
+            lines.append((number, data[start:end]))
+        if lines:
+            if len(files) == MAX_FILES:
+                truncated = True
+                break
+            files.append({'path': path, 'sha': sha, 'lines': lines})
+    return {'files': files, 'truncated': truncated, 'indexed': indexed}
@@ -0,0 +1,71 @@
+"""
+Measures how long it takes a fresh klaus process to become useful: the time to
+import klaus, to load the repository list and to answer the first (and second)
+request for each of the given URLs. Every run happens in a new process, with
+klaus configured by the usual environment variables::
+
+    KLAUS_REPOS=klaus python starttime.py / /klaus/tree/master/ /klaus/blob/master/klaus.py
+
+With ``KLAUS_CACHE_DIR`` set, the first run fills the persistent caches (e.g.
+compiled templates) and later runs show the warm startup.
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import subprocess
+
+
+def child(urls):
+    # measure the startup only, not background work started by the requests
+    os.environ['KLAUS_NO_BACKGROUND_INDEXING'] = '1'
+    results = {}
+    start = time.time()
+    import klaus
+    results['import'] = time.time() - start
+
+    start = time.time()
+    repos = len(klaus.app.repos)
+    results['registry'] = time.time() - start
+
+    client = klaus.app.test_client()
+    for url in urls:
+        for attempt in ['first', 'second']:
+            start = time.time()
+            response = client.get(url)
+            response.get_data()
+            results['%s %s' % (attempt, url)] = time.time() - start
+            if response.status_code >= 400:
+                sys.stderr.write('%s: %s\n' % (url, response.status))
+    json.dump({'repos': repos, 'seconds': results}, sys.stdout)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('urls', nargs='*', default=['/'])
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        return child(args.urls)
+
+    runs = []
+    for i in xrange(args.runs):
+        output = subprocess.check_output(
+            [sys.executable, os.path.abspath(__file__), '--child'] + args.urls,
+            cwd=os.path.dirname(os.path.abspath(__file__)))
+        runs.append(json.loads(output))
+    print '%d repositories, %d runs' % (runs[0]['repos'], len(runs))
+
+    keys = ['import', 'registry'] + ['%s %s' % (attempt, url) for url in args.urls
+                                     for attempt in ['first', 'second']]
+    print '%-40s %9s %9s %9s' % ('', 'first run', 'median', 'max')
+    for key in keys:
+        times = [run['seconds'][key] * 1000 for run in runs]
+        print '%-40s %7.1fms %7.1fms %7.1fms' % (
+            key, times[0], sorted(times)[len(times) // 2], max(times))
+
+
+if __name__ == '__main__':
+    main()
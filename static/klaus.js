@@ -0,0 +1,92 @@
+/* Navigation between the tree, file, blame, log and search views of a
+ * repository without reloading the page: such links are fetched with an
+ * `X-PJAX` header, which makes klaus send only the header and the content
+ * (without the tree listing if it didn't change), and those replace the
+ * current ones. Everything else is a normal page load. */
+(function() {
+  if (!window.history || !history.pushState || !document.querySelector) {
+    return;
+  }
+
+  // (repository, view) of a path like /<repo>/tree/<commit>/...
+  var VIEW_RE = /^(\/.+?)\/(tree|blob|blame|log|search)\/[^\/]+/;
+
+  function repository(path) {
+    var match = VIEW_RE.exec(path);
+    return match && match[1];
+  }
+
+  function load(url, push) {
+    var xhr = new XMLHttpRequest();
+    xhr.open('GET', url);
+    xhr.setRequestHeader('X-PJAX', 'true');
+    // the tree listing shown, which isn't sent again if it stays the same
+    var tree = document.querySelector('#content .tree');
+    if (tree && tree.getAttribute('data-key')) {
+      xhr.setRequestHeader('X-PJAX-Tree', tree.getAttribute('data-key'));
+    }
+    xhr.onload = function() {
+      var fragment = document.createElement('div');
+      if (xhr.status == 200) {
+        fragment.innerHTML = xhr.responseText;
+      }
+      var content = fragment.querySelector('#content');
+      var breadcrumbs = fragment.querySelector('.breadcrumbs');
+      var extraHeader = fragment.querySelector('.extra-header');
+      if (!content || !breadcrumbs || !extraHeader) {
+        window.location.href = url;
+        return;
+      }
+      var unchanged = content.querySelector('.tree[data-unchanged]');
+      if (unchanged && tree && unchanged.getAttribute('data-key') == tree.getAttribute('data-key')) {
+        unchanged.parentNode.replaceChild(tree, unchanged);
+      }
+      var target = document.querySelector('#content');
+      while (target.firstChild) {
+        target.removeChild(target.firstChild);
+      }
+      while (content.firstChild) {
+        target.appendChild(content.firstChild);
+      }
+      document.querySelector('header .breadcrumbs').innerHTML = breadcrumbs.innerHTML;
+      // the branch selector, which shows the current commit
+      document.querySelector('header .extra-header').innerHTML = extraHeader.innerHTML;
+      if (push) {
+        history.pushState({pjax: true}, '', url);
+        window.scrollTo(0, 0);
+      }
+    };
+    xhr.onerror = function() {
+      window.location.href = url;
+    };
+    xhr.send();
+  }
+
+  document.addEventListener('click', function(event) {
+    if (event.button !== 0 || event.metaKey || event.ctrlKey ||
+        event.shiftKey || event.altKey) {
+      return;
+    }
+    var link = event.target;
+    while (link && link.nodeName != 'A') {
+      link = link.parentNode;
+    }
+    if (!link || !link.href || link.host != window.location.host ||
+        link.getAttribute('target')) {
+      return;
+    }
+    var current = repository(window.location.pathname);
+    if (current === null || repository(link.pathname) !== current) {
+      return;
+    }
+    event.preventDefault();
+    load(link.href, true);
+  });
+
+  history.replaceState({pjax: true}, '', window.location.href);
+  window.addEventListener('popstate', function(event) {
+    if (event.state && event.state.pjax) {
+      load(window.location.href, false);
+    }
+  });
+})();
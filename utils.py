@@ -2,20 +2,61 @@ import re
 import os
 import stat
 import time
+import hashlib
 import mimetypes
 from future_builtins import map
 from functools import wraps
 
-from dulwich.objects import Commit, Blob
-from pygments import highlight
-from pygments.lexers import get_lexer_for_filename, get_lexer_by_name, \
-                            guess_lexer, ClassNotFound
-from pygments.formatters import HtmlFormatter
+from dulwich.objects import Commit
 from flask import g, abort
 
-
-
-def pygmentize(code, filename=None, language=None):
+import workers
+import metrics
+from cache import LRUCache, DiskCache, cache_dir
+
+
+
+@metrics.timed('highlight')
+def pygmentize(code, filename=None, language=None, cache_key=None):
+    """
+    Returns `code` highlighted as HTML. If `cache_key` (the sha of the blob
+    `code` was read from) is given, the result is cached.
+    """
+    if cache_key is not None:
+        cache_key = hashlib.sha1('\0'.join([
+            cache_key, (filename or '').encode('utf-8'), language or '',
+            pygments_options()
+        ])).hexdigest()
+        html = highlight_cache.get(cache_key)
+        if html is not None:
+            return html
+        html = highlight_disk_cache.get(cache_key)
+        if html is not None:
+            html = html.decode('utf-8')
+            highlight_cache.set(cache_key, html)
+            return html
+
+    fallback = []
+    def highlight_as_text():
+        fallback.append(True)
+        from pygments import highlight
+        from pygments.lexers import TextLexer
+        return highlight(code, TextLexer(), pygments_formatter())
+    html = workers.pool.run(_highlight, (code, filename, language),
+                            highlight_as_text)
+
+    if cache_key is not None and not fallback:
+        highlight_cache.set(cache_key, html)
+        highlight_disk_cache.set(cache_key, html.encode('utf-8'))
+    return html
+
+def _highlight(code, filename, language):
+    # Pygments is imported when it's first needed, which speeds up startup
+    # (finding a lexer for the first time is slow, too, as Pygments scans all
+    # installed packages for plugins then).
+    from pygments import highlight
+    from pygments.lexers import get_lexer_for_filename, get_lexer_by_name, \
+                                guess_lexer, ClassNotFound
     if language:
         lexer = get_lexer_by_name(language)
     else:
@@ -23,8 +64,27 @@ def pygmentize(code, filename=None, language=None):
             lexer = get_lexer_for_filename(filename)
         except ClassNotFound:
             lexer = guess_lexer(code)
-    return highlight(code, lexer, pygments_formatter)
-pygments_formatter = HtmlFormatter(linenos=True)
+    return highlight(code, lexer, pygments_formatter())
+
+_pygments_formatter = []
+def pygments_formatter():
+    if not _pygments_formatter:
+        from pygments.formatters import HtmlFormatter
+        _pygments_formatter.append(HtmlFormatter(linenos=True))
+    return _pygments_formatter[0]
+
+def pygments_options():
+    """ Returns a string describing the Pygments version and options used. """
+    import pygments
+    return '%s %r' % (pygments.__version__,
+                      sorted(pygments_formatter().options.items()))
+
+# highlighted HTML by blob sha, lexer and formatter options
+highlight_cache = LRUCache(
+    int(os.environ.get('KLAUS_HIGHLIGHT_CACHE_SIZE', 32*1024*1024)),
+    sizeof=len, name='highlight'
+)
+highlight_disk_cache = DiskCache(cache_dir('highlight'))
 
 def timesince(when, now=time.time):
     delta = now() - when
@@ -67,10 +127,21 @@ def timesince(when, now=time.time):
                      for n, unit in result[:2])
 
 def guess_is_binary(data):
+    """
+    Returns whether `data` (a string or an iterable of strings) looks binary.
+    Like git, only the first `BINARY_SNIFF_SIZE` bytes are checked for NULs.
+    """
     if isinstance(data, basestring):
-        return '\0' in data
-    else:
-        return any(map(guess_is_binary, data))
+        return '\0' in data[:BINARY_SNIFF_SIZE]
+    left = BINARY_SNIFF_SIZE
+    for chunk in data:
+        if '\0' in chunk[:left]:
+            return True
+        left -= len(chunk)
+        if left <= 0:
+            break
+    return False
+BINARY_SNIFF_SIZE = 8000
 
 def guess_is_image(filename):
     mime, encoding = mimetypes.guess_type(filename)
@@ -132,19 +203,41 @@ def listdir(repo, commit, path):
     dirs.sort()
     if root:
         dirs.insert(0, (None, '..', os.path.split(root)[0]))
-    return {'dirs' : dirs, 'files' : files}
+    # identifies the rendered listing, whose links contain the commit id
+    key = hashlib.sha1('\0'.join([g.commit_id.encode('utf-8'), root.encode('utf-8'),
+                                   tree.id])).hexdigest()
+    return {'dirs' : dirs, 'files' : files, 'key': key}
 
 def get_tree(repo, commit, path):
     root = path
-    tree = repo.get_tree(commit, root)
-    if isinstance(tree, Blob):
+    # the tree containing a file, without loading the file
+    mode, _ = repo.lookup_path(commit, root)
+    if not stat.S_ISDIR(mode):
         root = os.path.split(root)[0]
-        tree = repo.get_tree(commit, root)
-    return tree, root
+    return repo.get_tree(commit, root), root
 
 def get_blob(repo, commit, path):
     return repo.get_tree(commit, path)
 
+def slice_chunks(chunks, start, stop, chunk_size=64*1024):
+    """
+    Yields the bytes `start` to `stop` of the concatenation of `chunks` in
+    pieces of at most `chunk_size` bytes.
+    """
+    offset = 0
+    try:
+        for chunk in chunks:
+            lo = max(start - offset, 0)
+            hi = min(stop - offset, len(chunk))
+            for i in xrange(lo, hi, chunk_size):
+                yield chunk[i:min(i + chunk_size, hi)]
+            offset += len(chunk)
+            if offset >= stop:
+                break
+    finally:
+        if hasattr(chunks, 'close'):
+            chunks.close()
+
 def shorten_sha1(sha1):
     if re.match('[a-z\d]{20,40}', sha1):
         sha1 = sha1[:10]
@@ -0,0 +1,112 @@
+"""
+Optional process pool for CPU-bound rendering (highlighting, diffing).
+
+Pure-Python rendering holds the GIL, so in a threaded server one big file
+stalls every other request. With ``KLAUS_WORKER_PROCESSES`` set, such work is
+done in that many worker processes instead. Tasks that don't finish within
+``KLAUS_WORKER_TIMEOUT`` seconds, or that arrive while
+``KLAUS_WORKER_QUEUE_DEPTH`` tasks are already pending, are rendered the
+cheap way (e.g. as plain text) instead.
+"""
+import os
+import atexit
+import threading
+import traceback
+import multiprocessing
+
+
+class WorkerPool(object):
+    """
+    Runs functions in up to `processes` worker processes (in the calling
+    thread if `processes` is 0). The pool is started on first use, so it's
+    created in the process that uses it, not the one that imported klaus.
+    """
+    def __init__(self, processes, timeout, max_pending):
+        self.processes = processes
+        self.timeout = timeout
+        self.max_pending = max_pending
+        self.pending = 0
+        self.timeouts = self.rejections = 0
+        self._pool = None
+        self._closed = False
+        self._lock = threading.Lock()
+
+    def run(self, func, args, fallback):
+        """
+        Returns `func(*args)`, computed by a worker process. If the workers are
+        too busy or the result doesn't arrive in time, returns `fallback()`.
+        `func` and `args` must be picklable.
+        """
+        if not self.processes:
+            return func(*args)
+        with self._lock:
+            busy = self._closed or self.pending >= self.max_pending
+            if busy:
+                self.rejections += 1
+            else:
+                if self._pool is None:
+                    self._pool = multiprocessing.Pool(self.processes)
+                self.pending += 1
+                # `pending` counts a task until it's done, even after we
+                # stopped waiting for it, since it still occupies a worker.
+                result = self._pool.apply_async(_call, (func, args),
+                                                callback=self._task_done)
+        if busy:
+            return fallback()
+
+        try:
+            ok, value = result.get(self.timeout)
+        except multiprocessing.TimeoutError:
+            with self._lock:
+                self.timeouts += 1
+            return fallback()
+        if not ok:
+            raise RuntimeError('Worker process failed:\n' + value)
+        return value
+
+    def _task_done(self, result):
+        with self._lock:
+            self.pending -= 1
+
+    def terminate(self):
+        """
+        Stops the worker processes without waiting for abandoned tasks. Tasks
+        run after this get their fallback.
+        """
+        with self._lock:
+            self._closed = True
+            if self._pool is not None:
+                self._pool.terminate()
+
+
+def _call(func, args):
+    # Exceptions are passed on as text since they might not be picklable,
+    # and the pool wouldn't call `_task_done` for them.
+    try:
+        return True, func(*args)
+    except Exception:
+        return False, traceback.format_exc()
+
+
+# functions called on exit before the worker processes are stopped, e.g. to
+# stop threads that use them
+_exit_hooks = []
+
+def on_exit(func):
+    """ Registers `func` to be called on exit, before `pool` is terminated. """
+    _exit_hooks.append(func)
+    return func
+
+@atexit.register
+def _exit():
+    for func in _exit_hooks:
+        func()
+    pool.terminate()
+
+
+PROCESSES = int(os.environ.get('KLAUS_WORKER_PROCESSES', 0))
+pool = WorkerPool(
+    processes=PROCESSES,
+    timeout=float(os.environ.get('KLAUS_WORKER_TIMEOUT', 10)),
+    max_pending=int(os.environ.get('KLAUS_WORKER_QUEUE_DEPTH', 2 * PROCESSES)),
+)